@@ -0,0 +1,95 @@
+import os
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+class CostCache:
+    def __init__(self, max_bytes=2**30, folder=None):
+        """
+        content-addressed cache of cost volumes.
+        volumes live in memory until max_bytes is exceeded, then the least recently used ones
+        are spilled to .npy files in folder and read back as read-only memory maps.
+        :param max_bytes: memory budget for the resident volumes.
+        :param folder: spill directory (a temporary directory if None).
+        """
+        self.max_bytes = max_bytes
+        self.folder = folder if folder is not None else tempfile.mkdtemp(prefix="sem3d_costs_")
+        os.makedirs(self.folder, exist_ok=True)
+        self.memory = OrderedDict()
+        self.nbytes = 0
+
+    @staticmethod
+    def key(left, right, parameters, cost="census"):
+        """
+        hash of the image contents and of the parameters the cost volume depends on.
+        P1, P2 and bsize are deliberately left out: they only affect the later steps.
+        :param left: left image.
+        :param right: right image.
+        :param parameters: structure containing parameters of the algorithm.
+        :param cost: name of the matching cost.
+        :return: hexadecimal digest.
+        """
+        h = hashlib.sha1()
+        for img in (left, right):
+            img = np.ascontiguousarray(img)
+            h.update(f"{img.shape}{img.dtype}".encode())
+            h.update(img.data)
+        h.update(f"{cost}{tuple(parameters.csize)}{parameters.max_disparity}".encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, f"{key}.npy")
+
+    def __contains__(self, key):
+        return key in self.memory or os.path.isfile(self._path(key))
+
+    def get(self, key):
+        """
+        :param key: digest returned by CostCache.key.
+        :return: read-only cost volume (possibly a memory map), or None on a miss.
+        """
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        path = self._path(key)
+        if os.path.isfile(path):
+            return np.load(path, mmap_mode="r")
+        return None
+
+    def put(self, key, volume):
+        """
+        store a cost volume without copying it, then evict down to the memory budget.
+        :param key: digest returned by CostCache.key.
+        :param volume: H x W x D cost volume. It is flagged read-only since it may be shared.
+        :return: the stored volume.
+        """
+        volume.flags.writeable = False
+        if key in self.memory:
+            self.nbytes -= self.memory.pop(key).nbytes
+        self.memory[key] = volume
+        self.nbytes += volume.nbytes
+        while self.nbytes > self.max_bytes and len(self.memory) > 1:
+            self._spill()
+        return volume
+
+    def _spill(self):
+        """
+        move the least recently used volume from memory to disk.
+        """
+        key, volume = self.memory.popitem(last=False)
+        self.nbytes -= volume.nbytes
+        path = self._path(key)
+        if not os.path.isfile(path):
+            np.save(path, volume)
+
+    def clear(self):
+        """
+        drop every cached volume, in memory and on disk.
+        """
+        for key in list(self.memory):
+            self.nbytes -= self.memory.pop(key).nbytes
+        for f in os.listdir(self.folder):
+            if f.endswith(".npy"):
+                os.remove(os.path.join(self.folder, f))
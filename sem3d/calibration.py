@@ -0,0 +1,67 @@
+import cv2
+import numpy as np
+
+from .geometry import affine_mat, affine_point, affine_img, coord_imcenter
+
+class CalibrationPreview:
+    def __init__(self, img1, img2, q1, q2, scale=.25, x_margin=2):
+        """
+        fast preview for the manual calibration of t1, t2 and of the intrinsic alpha/skew.
+        images are downsampled once; every update applies a single affine transform
+        (intrinsic correction, rotation around the image center and translation alignment)
+        to the keypoints and, when rendered, to the downsampled proxies.
+        :param img1: first image (full resolution).
+        :param img2: second image (full resolution).
+        :param q1: N x 2 keypoints of img1.
+        :param q2: N x 2 matching keypoints of img2.
+        :param scale: downsampling factor of the proxies.
+        :param x_margin: margin of the translation alignment, as in rectification.translation_alignment.
+        """
+        self.imgs = (img1, img2)
+        self.q1 = np.asarray(q1, dtype=np.float64)
+        self.q2 = np.asarray(q2, dtype=np.float64)
+        self.scale = scale
+        self.x_margin = x_margin
+        self.centers = (coord_imcenter(img1), coord_imcenter(img2))
+        self.proxies = tuple(cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                             for img in self.imgs)
+
+    def transform(self, t1, t2, alpha=0, skew=0):
+        """
+        :return: the 2 x 2 matrices, the translation of img1, and the transformed keypoints.
+        """
+        mat1, mat2 = affine_mat(t1, alpha, skew), affine_mat(t2, alpha, skew)
+        c1, c2 = self.centers
+        q1 = affine_point(self.q1, mat1, c1)
+        q2 = affine_point(self.q2, mat2, c2)
+        diff = q1 - q2
+        translation = -np.array([[diff[:,0].max() + self.x_margin, diff[:,1].mean()]])
+        return mat1, mat2, translation, q1 + translation, q2
+
+    def update(self, t1, t2, alpha=0, skew=0):
+        """
+        keypoints and epipolar residuals for a setting, without touching the images.
+        :return: transformed q1, q2 and a dict of residual statistics (in full resolution pixels).
+        """
+        _, _, _, q1, q2 = self.transform(t1, t2, alpha, skew)
+        dx, dy = (q1 - q2).T
+        stats = {"dy_mean": dy.mean(),
+                 "dy_std": dy.std(),
+                 "dy_rms": np.sqrt((dy**2).mean()),
+                 "dy_max": np.abs(dy).max(),
+                 "dx_min": dx.min(),
+                 "dx_max": dx.max()}
+        return q1, q2, stats
+
+    def render(self, t1, t2, alpha=0, skew=0, full=False):
+        """
+        transformed images, from the proxies or at full resolution on demand.
+        :return: img1, img2, q1, q2 with the keypoints in the frame of the returned images.
+        """
+        mat1, mat2, translation, q1, q2 = self.transform(t1, t2, alpha, skew)
+        scale = 1 if full else self.scale
+        img1, img2 = self.imgs if full else self.proxies
+        c1, c2 = self.centers
+        img1 = affine_img(img1, mat1, c1 * scale, translation * scale)
+        img2 = affine_img(img2, mat2, c2 * scale)
+        return img1, img2, q1 * scale, q2 * scale
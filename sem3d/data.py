@@ -1,4 +1,4 @@
-from skimage.io import imread
+from skimage.io import imread, imsave
 import os
 
 key = lambda x: f"Mekki_1um_3000_20kV_20mm_{x}.jpg"
@@ -6,6 +6,7 @@ key = lambda x: f"Mekki_1um_3000_20kV_20mm_{x}.jpg"
 extensions = {"jpg", "TIF"}
 original  = "/home/tristan/workspace/sem/data/Original/"
 rectified = "/home/tristan/workspace/sem/data/Rectified/"
+results   = "/home/tristan/workspace/sem/data/Results/"
 
 
 def read_img(path, ds):
@@ -56,6 +57,13 @@ def rectified_imgs(ds, k1, k2):
     return (read_img(f"{rectified}/{ds}/{k1}_{k2}_left.jpg", ds), 
             read_img(f"{rectified}/{ds}/{k1}_{k2}_right.jpg", ds))
 
+def save_rectified(img1, img2, k1, k2, ds, folder=rectified):
+    """
+    """
+    os.makedirs(os.path.join(folder, ds), exist_ok=True)
+    imsave(f"{folder}/{ds}/{k1}_{k2}_left.jpg", img1, check_contrast=False)
+    imsave(f"{folder}/{ds}/{k1}_{k2}_right.jpg", img2, check_contrast=False)
+
 def rectified_keys(ds):
     """
     """
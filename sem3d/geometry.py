@@ -1,3 +1,4 @@
+import cv2
 import numpy as np
 from skimage.transform import rotate
 
@@ -46,6 +47,34 @@ def rotation_mat(t):
     return np.array([[np.cos(t), -np.sin(t)],
                      [np.sin(t), np.cos(t)]]).T
     
+def get_intrinsic(alpha, skew):
+    """
+        Correction of the aspect ratio (alpha) and skew of the images
+    """
+    return np.array([[1+alpha, 0], [skew,1]])
+
+def affine_mat(t, alpha=0, skew=0):
+    """
+        Intrinsic correction followed by the counter-clockwise rotation t, as a single 2 x 2 matrix
+    """
+    return rotation_mat(t) @ get_intrinsic(alpha, skew)
+
+def affine_point(q, mat, center=0, translation=0):
+    """
+        Applies mat around center to points, then translates them
+    """
+    return (q - center) @ mat.T + center + translation
+
+def affine_img(img, mat, center=0, translation=0):
+    """
+        Same transform as affine_point, on the image (one cv2.warpAffine, output has the shape of img)
+    """
+    offset = np.ravel(center + translation - np.ravel(center * np.ones(2)) @ mat.T)
+    M = np.concatenate([mat, offset[:,None]], axis=1)
+    if img.dtype == np.float64:
+        img = img.astype(np.float32)
+    return cv2.warpAffine(img, M, img.shape[1::-1], flags=cv2.INTER_LINEAR)
+
 def rotate_img(img, t):
     """
         Rotate points by a counter-clockwise rotation t
@@ -6,28 +6,56 @@ detectors = {
     "sift" : cv2.xfeatures2d.SIFT_create()
 }
 
-matchers = {
-    "akaze": cv2.BFMatcher(cv2.NORM_HAMMING),
-    "sift" : cv2.FlannBasedMatcher({"algorithm":0, "trees":5}, {"checks":50})
-}
-
 def match_keypoints(img1, img2, feat="sift", 
-                    filter_coef=.7, filter_dist=50, filter_intesity=20):
+                    filter_coef=.7, filter_dist=50, filter_intesity=20,
+                    mutual=True, y_band=None,
+                    roi=None, mask=None, levels=0, grid=64, max_per_cell=None):
+    """
+        y_band restricts the candidates of each keypoint to the keypoints of img2
+        less than y_band pixels above or below it (for roughly rectified pairs).
+        Keypoints are only detected on pixels brighter than filter_intesity,
+        inside roi and inside mask = (mask1, mask2), see detection_mask and detect_keypoints.
+    """
+    mask1 = detection_mask(img1, filter_intesity, roi, None if mask is None else mask[0])
+    mask2 = detection_mask(img2, filter_intesity, roi, None if mask is None else mask[1])
+    KP1, des1 = detect_keypoints(img1, feat, mask1, levels=levels, grid=grid, max_per_cell=max_per_cell)
+    KP2, des2 = detect_keypoints(img2, feat, mask2, levels=levels, grid=grid, max_per_cell=max_per_cell)
+    return match_descriptors(img1, img2, KP1, des1, KP2, des2, feat=feat,
+                             filter_coef=filter_coef, filter_dist=filter_dist,
+                             filter_intesity=filter_intesity, mutual=mutual, y_band=y_band)
+
+def match_descriptors(img1, img2, KP1, des1, KP2, des2, feat="sift",
+                      filter_coef=.7, filter_dist=50, filter_intesity=20,
+                      mutual=True, y_band=None):
+    """
+        Same as match_keypoints, from already detected keypoints (see detect_keypoints)
+    """
+    dist, idx, rev = knn_match(des1, des2, feat=feat, pts1=KP1, pts2=KP2, y_band=y_band)
+    return _select_matches(img1, img2, KP1, KP2, dist, idx, rev,
+                           filter_coef, filter_dist, filter_intesity, mutual)
+
+def _select_matches(img1, img2, KP1, KP2, dist, idx, rev,
+                    filter_coef, filter_dist, filter_intesity, mutual):
     """
     """
-    kp1, des1 = detectors[feat].detectAndCompute(img1, None)
-    kp2, des2 = detectors[feat].detectAndCompute(img2, None)
-    matches = matchers[feat].knnMatch(des1, des2, k=2)
-    nkp = len(matches)
+    msk = np.isfinite(dist[:,0])
+    nkp = msk.sum()
     
     print(f"{nkp} keypoints matched")
     if filter_coef:
-        matches = _filter_matches(matches, filter_coef)
-        nkp2 = len(matches)
+        msk = np.logical_and(msk, ratio_test(dist, filter_coef))
+        nkp2 = msk.sum()
         print(f"{nkp-nkp2} keypoints filtered by coef ({filter_coef}). {nkp2} remaings")
         nkp = nkp2
+
+    if mutual:
+        msk = np.logical_and(msk, mutual_check(idx, rev))
+        nkp2 = msk.sum()
+        print(f"{nkp-nkp2} keypoints filtered by mutual check. {nkp2} remaings")
+        nkp = nkp2
     
-    q1, q2 = _matches_to_np(kp1, kp2, matches)
+    matches = np.stack([np.flatnonzero(msk), idx[msk,0]], axis=1)
+    q1, q2 = _matches_to_np(KP1, KP2, matches)
     if filter_dist:
         q1,q2 = filter_by_dist(q1, q2, filter_dist)
         nkp2 = q1.shape[0]
@@ -41,18 +69,255 @@ def match_keypoints(img1, img2, feat="sift",
         
     return q1, q2
 
-def _filter_matches(matches, coef=.7):
+def detection_mask(img, thresh=None, roi=None, mask=None):
+    """
+        uint8 mask of the pixels where keypoints can be detected:
+        brighter than thresh, inside roi = (corner, size) as in plots.plot_patch, and inside mask.
+        Returns None when nothing is masked.
+    """
+    if not thresh and roi is None and mask is None:
+        return None
+    msk = np.full(img.shape[:2], 255, dtype=np.uint8)
+    if thresh:
+        msk[img <= thresh] = 0
+    if roi is not None:
+        (x, y), (w, h) = roi
+        msk[:y] = 0
+        msk[y+h:] = 0
+        msk[:,:x] = 0
+        msk[:,x+w:] = 0
+    if mask is not None:
+        msk[mask == 0] = 0
+    return msk
+
+def detect_keypoints(img, feat="sift", mask=None, levels=0, grid=64, max_per_cell=None):
     """
+        Detects and describes keypoints only where mask is set.
+        With levels > 0, detection and description run on the image downscaled levels times
+        (gaussian pyramid), and coordinates are scaled back to full resolution.
+        With max_per_cell, only the strongest keypoints of each grid x grid cell are described.
+        Returns keypoint coordinates (N x 2) and descriptors (N x ...)
     """
-    outs = []
-    for i,(m,n) in enumerate(matches):
-        if m.distance < coef * n.distance:
-            outs.append((m.queryIdx, m.trainIdx))
-    return np.array(outs)
+    det = detectors[feat]
+    if not levels and not max_per_cell:
+        kp, des = det.detectAndCompute(img, mask)
+        return _keypoints_to_np(kp), _descriptors(det, des)
+
+    for _ in range(levels):
+        img = cv2.pyrDown(img)
+        if mask is not None:
+            mask = cv2.resize(mask, img.shape[1::-1], interpolation=cv2.INTER_NEAREST)
+    kp = det.detect(img, mask)
+    if max_per_cell:
+        kp = _grid_cap(kp, grid / 2**levels, max_per_cell)
+    kp, des = det.compute(img, kp)
+    return _keypoints_to_np(kp) * 2**levels, _descriptors(det, des)
+
+def _descriptors(det, des):
+    """
+        cv2 returns None without keypoints, replaced by an empty (0, descriptorSize) array of the detector's type
+    """
+    if des is None:
+        dtype = np.uint8 if det.descriptorType() == cv2.CV_8U else np.float32
+        return np.zeros((0, det.descriptorSize()), dtype=dtype)
+    return des
+
+def _grid_cap(kp, grid, max_per_cell):
+    """
+        Keeps the max_per_cell keypoints with the highest response in each grid x grid cell
+    """
+    if len(kp) == 0:
+        return kp
+    pts = _keypoints_to_np(kp)
+    response = np.array([k.response for k in kp])
+    cx, cy = (pts // grid).astype(np.int64).T
+    cell = cy * (cx.max() + 1) + cx
+    order = np.lexsort((-response, cell))
+    cells = cell[order]
+    rank = np.arange(cells.size) - np.searchsorted(cells, cells, side="left")
+    keep = np.sort(order[rank < max_per_cell])
+    return [kp[i] for i in keep]
+
+def knn_match(des1, des2, feat="sift", k=2, pts1=None, pts2=None, y_band=None, chunk=1024):
+    """
+        Exact k nearest neighbours of des1 in des2, computed by blocks of chunk queries.
+        With y_band, only the keypoints of pts2 within y_band rows of pts1 are candidates.
+        Returns:
+            dist (N1 x k) and idx (N1 x k), inf / -1 where there are less than k candidates
+            rev (N2), the nearest neighbour of each des2 in des1 (-1 if none)
+    """
+    n1, n2 = des1.shape[0], des2.shape[0]
+    dist = np.full((n1, k), np.inf, dtype=np.float32)
+    idx  = np.full((n1, k), -1, dtype=np.int64)
+    rev_dist = np.full(n2, np.inf, dtype=np.float32)
+    rev  = np.full(n2, -1, dtype=np.int64)
+
+    if y_band is None:
+        order1, order2 = np.arange(n1), np.arange(n2)
+    else:
+        order1, order2 = np.argsort(pts1[:,1]), np.argsort(pts2[:,1])
+        y2 = pts2[order2,1]
+
+    for start in range(0, n1, chunk):
+        rows = order1[start:start+chunk]
+        if y_band is None:
+            cols = order2
+        else:
+            y1 = pts1[rows,1]
+            lo = np.searchsorted(y2, y1.min() - y_band, side="left")
+            hi = np.searchsorted(y2, y1.max() + y_band, side="right")
+            cols = order2[lo:hi]
+        if cols.size == 0:
+            continue
+
+        D = descriptor_distances(des1[rows], des2[cols], feat)
+        if y_band is not None:
+            D[np.abs(pts1[rows,1][:,None] - pts2[cols,1][None,:]) > y_band] = np.inf
+
+        top_dist, top = _topk(D, k)
+        dist[rows,:top.shape[1]] = top_dist
+        idx[rows,:top.shape[1]]  = cols[top]
+
+        best = D.argmin(0)
+        best_dist = D[best, np.arange(cols.size)]
+        better = best_dist < rev_dist[cols]
+        rev_dist[cols[better]] = best_dist[better]
+        rev[cols[better]] = rows[best[better]]
+
+    idx[~np.isfinite(dist)] = -1
+    return dist, idx, rev
+
+def descriptor_distances(des1, des2, feat="sift"):
+    """
+        N1 x N2 matrix of L2 (sift) or hamming (akaze) distances
+    """
+    m1, n1 = _descriptor_matrix(des1, feat)
+    m2, n2 = _descriptor_matrix(des2, feat)
+    return _gemm_distances(m1, n1, m2, n2, feat)
+
+def _descriptor_matrix(des, feat="sift"):
+    """
+        float32 matrix whose products give the distances, and its squared row norms.
+        akaze bits are mapped to +-1 so that hamming distances are (nbits - a.b) / 2, exact in float32.
+    """
+    if feat == "akaze":
+        m = np.unpackbits(des, axis=1).astype(np.float32)
+        m *= 2
+        m -= 1
+        return m, None
+    m = np.ascontiguousarray(des, dtype=np.float32)
+    return m, (m**2).sum(1)
+
+def _gemm_distances(m1, n1, m2, n2, feat="sift"):
+    """
+    """
+    D = m1 @ m2.T
+    if feat == "akaze":
+        D -= m1.shape[1]
+        D *= -.5
+        return D
+    D *= -2
+    D += n1[:,None]
+    D += n2[None,:]
+    return np.sqrt(np.maximum(D, 0, out=D), out=D)
+
+def _topk(D, k):
+    """
+        k smallest distances of each row of D, sorted, and their column indices
+    """
+    kk = min(k, D.shape[1])
+    top = np.argpartition(D, kk-1, axis=1)[:,:kk]
+    top_dist = np.take_along_axis(D, top, axis=1)
+    srt = np.argsort(top_dist, axis=1)
+    return np.take_along_axis(top_dist, srt, axis=1), np.take_along_axis(top, srt, axis=1)
+
+def match_series(imgs, feat="sift", pairs=None, chunk=2048,
+                 filter_coef=.7, filter_dist=50, filter_intesity=20, mutual=True,
+                 roi=None, levels=0, grid=64, max_per_cell=None):
+    """
+        Matches all the pairs of a tilt series at once.
+        Keypoints of every image are detected once and their descriptors stored in one contiguous
+        float32 block. Each image is then matched against all its partners with blocked matrix
+        products (chunk queries at a time), which give both directions of the mutual check at once.
+        imgs: {key: img}
+        pairs: list of (k1, k2), all the (keys[i], keys[j]), j < i by default (as data.get_pairs)
+        Returns {(k1, k2): (q1, q2)}, as match_keypoints(imgs[k1], imgs[k2])
+    """
+    keys = list(imgs)
+    if pairs is None:
+        pairs = [(keys[i], keys[j]) for i in range(len(keys)) for j in range(i)]
+
+    points, descriptors = {}, {}
+    for key in keys:
+        msk = detection_mask(imgs[key], filter_intesity, roi)
+        points[key], descriptors[key] = detect_keypoints(imgs[key], feat, msk, levels=levels,
+                                                         grid=grid, max_per_cell=max_per_cell)
+
+    sizes = [descriptors[key].shape[0] for key in keys]
+    offsets = dict(zip(keys, np.cumsum([0] + sizes)))
+    block, norms = _descriptor_matrix(np.concatenate([descriptors[key] for key in keys]), feat)
+    segment = lambda key: slice(offsets[key], offsets[key] + descriptors[key].shape[0])
+
+    out = {}
+    for k1 in keys:
+        partners = [k2 for a, k2 in pairs if a == k1]
+        if not partners:
+            continue
+        s1 = segment(k1)
+        n1 = s1.stop - s1.start
+        knn = {k2: (np.full((n1, 2), np.inf, dtype=np.float32),
+                    np.full((n1, 2), -1, dtype=np.int64),
+                    np.full(s2.stop - s2.start, np.inf, dtype=np.float32),
+                    np.full(s2.stop - s2.start, -1, dtype=np.int64))
+               for k2, s2 in ((k2, segment(k2)) for k2 in partners)}
+
+        for start in range(0, n1, chunk):
+            rows = slice(s1.start + start, min(s1.start + start + chunk, s1.stop))
+            local = slice(start, start + rows.stop - rows.start)
+            for k2 in partners:
+                s2 = segment(k2)
+                if s2.stop == s2.start:
+                    continue
+                D = _gemm_distances(block[rows], None if norms is None else norms[rows],
+                                    block[s2], None if norms is None else norms[s2], feat)
+                dist, idx, rev_dist, rev = knn[k2]
+                top_dist, top = _topk(D, 2)
+                dist[local,:top.shape[1]] = top_dist
+                idx[local,:top.shape[1]] = top
+
+                best = D.argmin(0)
+                best_dist = D[best, np.arange(D.shape[1])]
+                better = best_dist < rev_dist
+                rev_dist[better] = best_dist[better]
+                rev[better] = best[better] + start
+
+        for k2 in partners:
+            dist, idx, _, rev = knn[k2]
+            print(f"Pair ({k1}, {k2})")
+            out[(k1, k2)] = _select_matches(imgs[k1], imgs[k2], points[k1], points[k2], dist, idx, rev,
+                                            filter_coef, filter_dist, filter_intesity, mutual)
+    return out
+
+def ratio_test(dist, coef=.7):
+    """
+        Boolean mask of the matches whose nearest neighbour is much closer than the second one
+        Matches without second candidate (e.g. left alone by y_band) can not be checked and are rejected
+    """
+    return np.logical_and(np.isfinite(dist[:,1]), dist[:,0] < coef * dist[:,1])
+
+def mutual_check(idx, rev):
+    """
+        Boolean mask of the matches that are also the nearest neighbour the other way round
+    """
+    msk = idx[:,0] >= 0
+    msk[msk] = rev[idx[msk,0]] == np.flatnonzero(msk)
+    return msk
 
 def filter_by_dist(q1, q2, max_dist=100):
     """
     """
+    if q1.shape[0] == 0:
+        return q1, q2
     msk = np.linalg.norm(_center(q1) - _center(q2), axis=1) < max_dist
     return q1[msk], q2[msk]
 
@@ -71,11 +336,16 @@ def _center(x):
     """
     return x-x.mean(0, keepdims=True)
 
+def _keypoints_to_np(kp):
+    """
+    """
+    return np.array(cv2.KeyPoint_convert(kp), dtype=np.float64).reshape(-1, 2)
+
 def _matches_to_np(kp1, kp2, matches):
     """
     """
-    KP1 = np.array(list(map(lambda x:x.pt, kp1)))
-    KP2 = np.array(list(map(lambda x:x.pt, kp2)))
+    KP1 = kp1 if isinstance(kp1, np.ndarray) else _keypoints_to_np(kp1)
+    KP2 = kp2 if isinstance(kp2, np.ndarray) else _keypoints_to_np(kp2)
     return KP1[matches[:,0]], KP2[matches[:,1]]
 
 ###
@@ -0,0 +1,422 @@
+"""
+End-to-end runner from a raw tilt series to rectified pairs, disparity maps and point clouds.
+
+    python -m sem3d.pipeline Pollen --crop 600 --workers 2 --sgm-workers 4
+
+With --plan, the pairs are selected by planner.plan instead of all the data.get_pairs.
+With --prior-radius, the pairs of a reference image are matched by propagation.SeriesSGM, in tilt order.
+
+Every pair goes through the load, detect, match, rectify, sgm and export stages.
+Stages are connected by bounded queues and each one has its own pool of worker threads,
+so image decoding and writing overlap with compute. A checkpoint is written per finished pair
+and pairs that already have one, written with the same settings, are skipped, so an interrupted run
+resumes where it stopped.
+"""
+import os
+import sys
+import json
+import time as t
+import argparse
+import threading
+import traceback
+from queue import Queue
+
+import cv2
+import numpy as np
+
+from . import data
+from .kp import detection_mask, detect_keypoints, match_descriptors
+from .ransac_skim import filter_outliers
+from .rectification import _rectify
+from .pysgm import Parameters, SGMMatcher
+from .propagation import SeriesSGM
+from .planner import plan
+
+_STOP = object()
+
+# arguments the outputs depend on, a checkpoint written with other values does not count
+_SETTINGS = ("crop", "no_sgm", "feat", "levels", "max_per_cell", "intensity_threshold", "residual_threshold",
+             "coef_threshold", "dist_threshold", "min_samples", "x_margin", "max_disparity", "P1", "P2", "csize",
+             "prior_radius")
+
+class Stage:
+    def __init__(self, name, fn, inputs, outputs, workers=1):
+        """
+        pool of worker threads applying fn to the items of the inputs queue.
+        items for which fn raises are reported and dropped, the other pairs go on.
+        :param name: name of the stage, for the logs.
+        :param fn: function item -> item.
+        :param inputs: queue to read from, terminated by _STOP.
+        :param outputs: queue to write to, or None for the last stage.
+        :param workers: number of threads.
+        """
+        self.name = name
+        self.fn = fn
+        self.inputs = inputs
+        self.outputs = outputs
+        self.running = workers
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True)
+                        for i in range(workers)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            item = self.inputs.get()
+            if item is _STOP:
+                # let the sibling threads see it, the last one forwards it
+                self.inputs.put(_STOP)
+                self._finish()
+                return
+            self._apply(item)
+
+    def _apply(self, item):
+        try:
+            dawn = t.time()
+            item = self.fn(item)
+            item["timings"][self.name] = t.time() - dawn
+        except Exception:
+            print(f"[{self.name}] pair {item['pair']} failed:", file=sys.stderr)
+            traceback.print_exc()
+            return
+        if self.outputs is not None:
+            self.outputs.put(item)
+
+    def _finish(self):
+        with self.lock:
+            self.running -= 1
+            last = self.running == 0
+        if last and self.outputs is not None:
+            self.outputs.put(_STOP)
+
+class KeyedStage(Stage):
+    def __init__(self, name, fn, inputs, outputs, rank, workers=1):
+        """
+        stage whose items are dispatched by key: all the items of a key go to the same worker thread,
+        which applies fn to them in the order of their index. an item waits for the ones before it,
+        those that never come (failed upstream) are skipped once the inputs are exhausted.
+        :param rank: function item -> (key, index), indices of a key are 0, 1, 2...
+        """
+        super().__init__(name, fn, inputs, outputs, workers)
+        self.rank = rank
+        self.queues = [Queue(maxsize=inputs.maxsize) for _ in range(workers)]
+        self.assigned = {}
+        self.threads = [threading.Thread(target=self._work, args=(i,), name=f"{name}-{i}", daemon=True)
+                        for i in range(workers)]
+        self.threads.append(threading.Thread(target=self._dispatch, name=f"{name}-dispatch", daemon=True))
+
+    def _dispatch(self):
+        while True:
+            item = self.inputs.get()
+            if item is _STOP:
+                for queue in self.queues:
+                    queue.put(_STOP)
+                return
+            key, _ = self.rank(item)
+            # keys are spread over the workers in their order of arrival
+            worker = self.assigned.setdefault(key, len(self.assigned) % len(self.queues))
+            self.queues[worker].put(item)
+
+    def _work(self, i):
+        pending, expected = {}, {}
+        while True:
+            item = self.queues[i].get()
+            if item is _STOP:
+                for items in pending.values():
+                    for index in sorted(items):
+                        self._apply(items[index])
+                self._finish()
+                return
+            key, index = self.rank(item)
+            items = pending.setdefault(key, {})
+            items[index] = item
+            while expected.get(key, 0) in items:
+                self._apply(items.pop(expected.get(key, 0)))
+                expected[key] = expected.get(key, 0) + 1
+
+class _Memo:
+    def __init__(self, fn):
+        """
+        thread-safe cache of fn per key, so an image shared by several pairs is processed once.
+        a key is evicted once it has been released as many times as it was retained.
+        """
+        self.fn = fn
+        self.values = {}
+        self.locks = {}
+        self.refs = {}
+        self.lock = threading.Lock()
+
+    def retain(self, key):
+        with self.lock:
+            self.refs[key] = self.refs.get(key, 0) + 1
+
+    def release(self, key):
+        with self.lock:
+            self.refs[key] -= 1
+            if self.refs[key] == 0:
+                del self.refs[key]
+                self.values.pop(key, None)
+                self.locks.pop(key, None)
+
+    def __call__(self, key, *args):
+        with self.lock:
+            lock = self.locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self.values:
+                self.values[key] = self.fn(*args)
+            return self.values[key]
+
+class Pipeline:
+    def __init__(self, ds, args):
+        """
+        :param ds: name of the dataset (sub-folder of the original and output folders).
+        :param args: parsed command line arguments.
+        """
+        self.ds = ds
+        self.args = args
+        self.folder = os.path.join(args.original, ds)
+        # disparities, clouds and checkpoints stay out of the rectified folder, listed by data.rectified_keys
+        self.output = os.path.join(args.results, ds)
+        self.checkpoints = os.path.join(self.output, "checkpoints")
+        os.makedirs(self.checkpoints, exist_ok=True)
+        self.parameters = Parameters(max_disparity=args.max_disparity, P1=args.P1, P2=args.P2,
+                                     csize=(args.csize, args.csize), bsize=(3, 3))
+        self.settings = {name: getattr(args, name) for name in _SETTINGS}
+        self.images = _Memo(self._read)
+        self.features = _Memo(self._detect)
+        self.matchers = threading.local()
+
+    def _checkpoint(self, k1, k2):
+        return os.path.join(self.checkpoints, f"{k1}_{k2}.json")
+
+    def done(self, k1, k2):
+        """
+        whether the pair has a checkpoint written with the current settings.
+        """
+        path = self._checkpoint(k1, k2)
+        if not os.path.isfile(path):
+            return False
+        with open(path) as f:
+            return json.load(f).get("settings") == self.settings
+
+    def todo(self, pairs):
+        """
+        pairs without up to date checkpoint.
+        """
+        return [(k1, k2) for k1, k2 in pairs if not self.done(k1, k2)]
+
+    def _read(self, key):
+        img = data.read_img(os.path.join(self.folder, key), self.ds)
+        if self.args.crop:
+            img = img[:self.args.crop]
+        return img
+
+    def _detect(self, key, img):
+        mask = detection_mask(img, self.args.intensity_threshold)
+        return detect_keypoints(img, self.args.feat, mask,
+                                levels=self.args.levels, max_per_cell=self.args.max_per_cell)
+
+    def _release(self, pair):
+        for key in pair:
+            self.images.release(key)
+            self.features.release(key)
+
+    def load(self, item):
+        k1, k2 = item["pair"]
+        try:
+            item["img1"], item["img2"] = self.images(k1, k1), self.images(k2, k2)
+        except Exception:
+            self._release(item["pair"])
+            raise
+        return item
+
+    def detect(self, item):
+        k1, k2 = item["pair"]
+        try:
+            item["kp1"] = self.features(k1, k1, item["img1"])
+            item["kp2"] = self.features(k2, k2, item["img2"])
+        finally:
+            # the item keeps its own references, the caches only serve the pairs still to come
+            self._release(item["pair"])
+        return item
+
+    def match(self, item):
+        (KP1, des1), (KP2, des2) = item.pop("kp1"), item.pop("kp2")
+        item["q1"], item["q2"] = match_descriptors(item["img1"], item["img2"], KP1, des1, KP2, des2,
+                                                   feat=self.args.feat,
+                                                   filter_coef=self.args.coef_threshold,
+                                                   filter_dist=self.args.dist_threshold,
+                                                   filter_intesity=self.args.intensity_threshold)
+        return item
+
+    def rectify(self, item):
+        q1, q2 = filter_outliers(item.pop("q1"), item.pop("q2"),
+                                 min_samples=self.args.min_samples,
+                                 residual_threshold=self.args.residual_threshold)
+        img1, img2, q1, q2, rect = _rectify(item.pop("img1"), item.pop("img2"), q1, q2,
+                                            x_margin=self.args.x_margin, return_params=True)
+        item.update(img1=img1, img2=img2, q1=q1, q2=q2, rect=rect)
+        return item
+
+    def sgm(self, item):
+        if self.args.no_sgm:
+            return item
+        # same convention as the SGM notebook: disparities are in the frame of img1
+        bsize = self.parameters.bsize
+        right = cv2.GaussianBlur(item["img1"], bsize, 0, 0)
+        left = cv2.GaussianBlur(item["img2"], bsize, 0, 0)
+        if self.args.prior_radius:
+            return self._sgm_series(item, left, right)
+        # one matcher per thread, its buffers are reused from one pair to the next
+        if not hasattr(self.matchers, "matcher"):
+            self.matchers.matcher = SGMMatcher(self.parameters)
+        item["disparity"] = np.empty(left.shape, dtype=np.intp)
+        self.matchers.matcher.compute(left, right, out=item["disparity"])
+        return item
+
+    def _sgm_series(self, item, left, right):
+        """
+        prior propagation: the KeyedStage hands all the pairs of a reference image to the same thread,
+        from the closest tilt to the farthest, so each one reuses the disparities of the previous one.
+        """
+        if not hasattr(self.matchers, "series"):
+            self.matchers.series = SeriesSGM(self.parameters, radius=self.args.prior_radius)
+        series = self.matchers.series
+        k1, _ = item["pair"]
+        item["disparity"] = series.compute(item["pair"], right, left, item["q1"], item["q2"], item["rect"])
+        if self.ranks[item["pair"]][1] == self.counts[k1] - 1:
+            series.last.pop(k1, None)
+        return item
+
+    def _rank(self, item):
+        return self.ranks[item["pair"]]
+
+    def order(self, pairs):
+        """
+        index of each pair among the pairs of its reference image, by increasing tilt difference
+        (keys are sorted in tilt order, as data.list_imgs).
+        :return: {pair: (k1, index)}, {k1: number of pairs}
+        """
+        position = {k: i for i, k in enumerate(sorted({k for pair in pairs for k in pair}))}
+        ranks, counts = {}, {}
+        for k1, k2 in sorted(pairs, key=lambda p: abs(position[p[0]] - position[p[1]])):
+            ranks[(k1, k2)] = (k1, counts.get(k1, 0))
+            counts[k1] = counts.get(k1, 0) + 1
+        return ranks, counts
+
+    def export(self, item):
+        k1, k2 = item["pair"]
+        data.save_rectified(item["img1"], item["img2"], k1, k2, self.ds, folder=self.args.output)
+        if "disparity" in item:
+            disp = item["disparity"]
+            Y, X = np.indices(disp.shape)
+            np.save(os.path.join(self.output, f"{k1}_{k2}_disparity.npy"), disp)
+            np.save(os.path.join(self.output, f"{k1}_{k2}_cloud.npy"),
+                    np.stack([X.ravel(), Y.ravel(), disp.ravel().astype(X.dtype)]))
+
+        stats = {"pair": [k1, k2], "keypoints": int(item["q1"].shape[0]), "timings": item["timings"],
+                 "settings": self.settings}
+        path = self._checkpoint(k1, k2)
+        with open(path + ".tmp", "w") as f:
+            json.dump(stats, f)
+        os.replace(path + ".tmp", path)
+        print(f"Pair ({k1}, {k2}) done")
+        return item
+
+    def run(self, pairs):
+        """
+        runs all the stages over the pairs that have no checkpoint yet.
+        :param pairs: list of (k1, k2) keys.
+        :return: number of pairs processed.
+        """
+        pairs = self.todo(pairs)
+        print(f"{len(pairs)} pairs to process")
+        args = self.args
+        self.ranks, self.counts = self.order(pairs)
+        keyed = args.prior_radius and not args.no_sgm
+        if keyed:
+            # feed the pairs in the order the KeyedStage consumes them, so that it only buffers
+            # the few items the parallel upstream workers put out of order
+            pairs = sorted(pairs, key=lambda pair: self.ranks[pair][::-1])
+        stages = [("load", self.load, args.workers),
+                  ("detect", self.detect, args.workers),
+                  ("match", self.match, args.workers),
+                  ("rectify", self.rectify, args.workers),
+                  ("sgm", self.sgm, args.sgm_workers),
+                  ("export", self.export, args.workers)]
+        queues = [Queue(maxsize=args.queue_size) for _ in stages]
+        # an image and its features are dropped once all its pairs have passed the detect stage
+        for memo in (self.images, self.features):
+            for pair in pairs:
+                for key in pair:
+                    memo.retain(key)
+        running = []
+        for i, (name, fn, workers) in enumerate(stages):
+            outputs = queues[i + 1] if i + 1 < len(stages) else None
+            if name == "sgm" and keyed:
+                running.append(KeyedStage(name, fn, queues[i], outputs, self._rank, workers).start())
+            else:
+                running.append(Stage(name, fn, queues[i], outputs, workers).start())
+        for pair in pairs:
+            queues[0].put({"pair": pair, "timings": {}})
+        queues[0].put(_STOP)
+        for stage in running:
+            stage.join()
+        return len(pairs) - len(self.todo(pairs))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Rectification and SGM over all the pairs of a tilt series.")
+    parser.add_argument("dataset")
+    parser.add_argument("--original", default=data.original, help="folder of the raw datasets")
+    parser.add_argument("--output", default=data.rectified, help="folder of the rectified datasets")
+    parser.add_argument("--results", default=data.results, help="folder of the disparities, clouds and checkpoints")
+    parser.add_argument("--crop", type=int, default=0, help="keep only the first rows of the images (0: keep all)")
+    parser.add_argument("--workers", type=int, default=2, help="threads per stage")
+    parser.add_argument("--sgm-workers", type=int, default=2, help="threads of the sgm stage")
+    parser.add_argument("--queue-size", type=int, default=4, help="pairs buffered between two stages")
+    parser.add_argument("--no-sgm", action="store_true", help="only rectify the pairs")
+    parser.add_argument("--prior-radius", type=int, default=0,
+                        help="search disparities within this radius of the previous pair of the same image (0: off)")
+    parser.add_argument("--plan", action="store_true", help="select the pairs on thumbnails instead of all pairs")
+    parser.add_argument("--budget", type=int, default=None, help="number of planned pairs (default: a spanning tree)")
+    parser.add_argument("--window", type=int, default=None, help="planner candidates: keys at most this far apart")
+    parser.add_argument("--feat", default="sift", choices=["sift", "akaze"])
+    parser.add_argument("--levels", type=int, default=0)
+    parser.add_argument("--max-per-cell", type=int, default=None)
+    parser.add_argument("--intensity-threshold", type=float, default=50)
+    parser.add_argument("--residual-threshold", type=float, default=.1)
+    parser.add_argument("--coef-threshold", type=float, default=.7)
+    parser.add_argument("--dist-threshold", type=float, default=30)
+    parser.add_argument("--min-samples", type=int, default=5)
+    parser.add_argument("--x-margin", type=float, default=2)
+    parser.add_argument("--max-disparity", type=int, default=64)
+    parser.add_argument("--P1", type=int, default=5)
+    parser.add_argument("--P2", type=int, default=70)
+    parser.add_argument("--csize", type=int, default=7)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    pipeline = Pipeline(args.dataset, args)
+    keys = data.list_imgs(pipeline.folder)
+    dawn = t.time()
+    if args.plan:
+        # read outside of the cache, which only keeps the images of the pairs to run
+        pairs, _ = plan({k: pipeline._read(k) for k in keys}, budget=args.budget, window=args.window,
+                        feat=args.feat, filter_coef=args.coef_threshold, filter_dist=args.dist_threshold,
+                        filter_intesity=args.intensity_threshold, max_disparity=args.max_disparity)
+    else:
+        pairs = data.get_pairs(keys)
+    pipeline.run(pairs)
+    print(f"Done in {t.time() - dawn:.2f} s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import cv2
+import numpy as np
+
+from .kp import match_series
+from .ransac_skim import ransac, FundamentalMatrix
+from .rectification import _rectify
+
+def thumbnails(imgs, scale=.25):
+    """
+    :param imgs: {key: img}
+    :return: {key: downsampled img}
+    """
+    return {k: cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            for k, img in imgs.items()}
+
+def candidate_pairs(keys, window=None):
+    """
+        Same pairs and orientation as data.get_pairs, restricted to the keys at most window apart
+        in the (tilt) order of keys, so that their number grows linearly with the series.
+    """
+    keys = list(keys)
+    window = len(keys) if window is None else window
+    return [(keys[i], keys[j]) for i in range(len(keys)) for j in range(max(i - window, 0), i)]
+
+def pair_stats(thumb1, thumb2, q1, q2, scale=.25, min_samples=5, residual_threshold=.5):
+    """
+        Conditioning of a pair from its thumbnail matches: RANSAC inliers, overlap of the matched area,
+        and x-disparities once the keypoints are rectified with _rectify. The parallax (spread of
+        the disparities around their linear trend) grows with the tilt difference times the relief,
+        the disparity range has to fit in the SGM search range.
+        Lengths are returned in full resolution pixels.
+    """
+    stats = {"matches": int(q1.shape[0]), "inliers": 0., "overlap": 0., "parallax": 0., "range": np.inf}
+    if q1.shape[0] < 2 * min_samples:
+        return stats
+    _, inliers = ransac((q1, q2), FundamentalMatrix,
+                        min_samples=min_samples,
+                        residual_threshold=residual_threshold)
+    if inliers is None or inliers.sum() < 2 * min_samples:
+        return stats
+    q1, q2 = q1[inliers], q2[inliers]
+
+    _, _, r1, r2 = _rectify(thumb1, thumb2, q1, q2)
+    dx = (r2 - r1)[:,0]
+    A = np.stack([r1[:,0], np.ones_like(dx)], axis=1)
+    trend, *_ = np.linalg.lstsq(A, dx, rcond=None)
+    low, high = np.percentile(dx - A @ trend, [5, 95])
+
+    hull = cv2.convexHull(q1.astype(np.float32))
+    stats.update(inliers=inliers.mean(),
+                 overlap=cv2.contourArea(hull) / thumb1.size,
+                 parallax=(high - low) / scale,
+                 range=(dx.max() - dx.min()) / scale)
+    return stats
+
+def pair_score(stats, target_parallax=8, max_disparity=64):
+    """
+        Score in [0, 1]: inlier ratio x overlap x baseline, 0 for pairs SGM can not match.
+    """
+    if stats["range"] > max_disparity:
+        return 0.
+    return stats["inliers"] * stats["overlap"] * min(stats["parallax"] / target_parallax, 1)
+
+def select_pairs(keys, scores, budget=None):
+    """
+        Maximum spanning tree of the pairs (Kruskal), then the best remaining pairs up to budget.
+        keys: list of keys
+        scores: {(k1, k2): score}, pairs scoring 0 are never selected
+        budget: total number of pairs, len(keys) - 1 (the tree) by default
+        Returns the list of selected pairs, by decreasing score
+    """
+    parent = {k: k for k in keys}
+    def root(k):
+        while parent[k] != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+
+    ranked = sorted((p for p, s in scores.items() if s > 0), key=lambda p: -scores[p])
+    tree, extra = [], []
+    for k1, k2 in ranked:
+        r1, r2 = root(k1), root(k2)
+        if r1 != r2:
+            parent[r1] = r2
+            tree.append((k1, k2))
+        else:
+            extra.append((k1, k2))
+
+    components = len({root(k) for k in keys})
+    if components > 1:
+        print(f"Warning: the selected pairs leave {components} disconnected groups of images")
+    budget = len(tree) if budget is None else max(budget, len(tree))
+    return sorted(tree + extra[:budget - len(tree)], key=lambda p: -scores[p])
+
+def plan(imgs, budget=None, window=None, scale=.25, feat="sift",
+         filter_coef=.7, filter_dist=50, filter_intesity=20,
+         min_samples=5, residual_threshold=.5, target_parallax=8, max_disparity=64):
+    """
+        Replaces data.get_pairs: scores the candidate pairs on thumbnails and selects a connected set
+        of well conditioned pairs, for a budget of pairs to rectify and match at full resolution.
+        imgs: {key: img}, keys in tilt order
+        Returns the selected pairs, and {pair: stats} with their score
+    """
+    keys = list(imgs)
+    thumbs = thumbnails(imgs, scale)
+    matches = match_series(thumbs, feat, candidate_pairs(keys, window),
+                           filter_coef=filter_coef,
+                           filter_dist=filter_dist * scale,
+                           filter_intesity=filter_intesity)
+    stats = {}
+    for (k1, k2), (q1, q2) in matches.items():
+        stats[(k1, k2)] = pair_stats(thumbs[k1], thumbs[k2], q1, q2, scale, min_samples, residual_threshold)
+        stats[(k1, k2)]["score"] = pair_score(stats[(k1, k2)], target_parallax, max_disparity)
+    pairs = select_pairs(keys, {p: s["score"] for p, s in stats.items()}, budget)
+    print(f"{len(pairs)} pairs selected out of {len(stats)} candidates")
+    return pairs, stats
@@ -1,55 +1,72 @@
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
+from matplotlib.collections import LineCollection
 import numpy as np
 from .ransac_skim import FundamentalMatrix
 
 def draw_line(a=1, b=1, e=[0], width=800, ax=None, c="red"):
+    """
+        Draws the lines a*x + b*y + e = 0 for all e as a single LineCollection
+    """
     if ax is None:
         fig, ax = plt.subplots(figsize=(10,10))
 
-    x = np.array([0,width])
-    for e_ in e:
-        ax.plot(x, -(a*x + e_) / b, '-', c=c)
+    e = np.asarray(e, dtype=np.float64).reshape(-1)
+    x = np.array([0,width], dtype=np.float64)
+    y = -(a*x[None,:] + e[:,None]) / b
+    segments = np.stack([np.broadcast_to(x, y.shape), y], axis=-1)
+    ax.add_collection(LineCollection(segments, colors=c))
+    ax.autoscale_view()
 
-def plot_epipolar_lines(img1, img2, q1, q2, ax=None, npoints=5):
+def plot_epipolar_lines(img1, img2, q1, q2, ax=None, npoints=5, model=None):
     """
+        model: FundamentalMatrix already fitted on (q1, q2), e.g. by filter_outliers(..., return_model=True).
+        Fitted here if None.
     """
     if isinstance(npoints, int):
-        idx = np.random.choice(q1.shape[0], size=npoints, replace=False)
+        idx = np.random.choice(q1.shape[0], size=min(npoints, q1.shape[0]), replace=False)
     else:
         idx = npoints
     if ax is None:
         fig, ax = plt.subplots(1,2, figsize=(20,10))
-    fund = FundamentalMatrix()
-    t1,t2 = fund.estimate((q1, q2))
-    a1, b1, es1 = fund.get_l1(q1)
-    a2, b2, es2 = fund.get_l2(q2)
+    if model is None:
+        model = FundamentalMatrix()
+        model.estimate((q1, q2))
+    t1,t2 = model.get_thetas()
+    a1, b1, es1 = model.get_l1(q1[idx])
+    a2, b2, es2 = model.get_l2(q2[idx])
 
     ax[0].imshow(img1)
     ax[0].scatter(q1[idx,0], q1[idx,1], c="yellow")
-    draw_line(a=a2, b=b2, e=es2[idx], width=img1.shape[1], ax=ax[0], c="red")
+    draw_line(a=a2, b=b2, e=es2, width=img1.shape[1], ax=ax[0], c="red")
 
     ax[1].imshow(img2)
     ax[1].scatter(q2[idx,0], q2[idx,1], c="yellow")
-    draw_line(a=a1, b=b1, e=es1[idx], width=img2.shape[1], ax=ax[1], c="red")
+    draw_line(a=a1, b=b1, e=es1, width=img2.shape[1], ax=ax[1], c="red")
     return t1, t2
 
-def plot_disp(q1, q2, bins=100, ax=None):
+def plot_disp(q1, q2, bins=100, ax=None, model=None, residuals=None):
     """
+        residuals: residuals of (q1, q2), computed from model (fitted here if None) if not given.
     """
     if ax is not None:
         assert len(ax)==3
     else:
         fig, ax = plt.subplots(1,3, figsize=(30,10))
-    fund = FundamentalMatrix() 
-    fund.estimate((q1, q2))
-    res = fund.residuals((q1, q2))
+    if residuals is None:
+        if model is None:
+            model = FundamentalMatrix() 
+            model.estimate((q1, q2))
+        residuals = model.residuals((q1, q2))
     
-    ax[0].hist((q1-q2)[:,0], bins=100)
-    ax[1].hist((q1-q2)[:,1], bins=100)
-    ax[2].hist(res, bins=100)
+    ax[0].hist((q1-q2)[:,0], bins=bins)
+    ax[1].hist((q1-q2)[:,1], bins=bins)
+    ax[2].hist(residuals, bins=bins)
     
-def plot_disp_trends(q1, q2, ax=None):
+def plot_disp_trends(q1, q2, ax=None, max_points=5000, bins=200):
+    """
+        Above max_points matches, each panel is a bins x bins density image instead of a scatter plot.
+    """
     if ax is None:
         fig,ax = plt.subplots(2,2, figsize=(20,20))
     x_y_axis = (q1[:,0], q1[:,1])
@@ -57,7 +74,12 @@ def plot_disp_trends(q1, q2, ax=None):
 
     for i,axis in enumerate(x_y_axis):
         for j,diff in enumerate(x_y_diff):
-            ax[j,i].scatter(axis, diff)
+            if axis.shape[0] > max_points:
+                density, xedges, yedges = np.histogram2d(axis, diff, bins=bins)
+                ax[j,i].imshow(np.log1p(density.T), origin="lower", aspect="auto",
+                               extent=(xedges[0], xedges[-1], yedges[0], yedges[-1]))
+            else:
+                ax[j,i].scatter(axis, diff, s=4)
     
 def plot_patch(img, corner=(200, 400), size=(400, 50), ax=None):
     x,y = corner
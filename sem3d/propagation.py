@@ -0,0 +1,104 @@
+import cv2
+import numpy as np
+
+from .geometry import affine_mat, coord_imcenter
+from .pysgm import SGMMatcher, sgm_window, fill_invalid
+
+def warp_disparity(disparity_map, rect_from, rect_to):
+    """
+    warps a disparity map of the rectified pair (k1, k2) into the rectified frame of k1 in another pair (k1, k3).
+    :param disparity_map: H x W disparities, in the frame of k1.
+    :param rect_from: (t1, t2, translation) of (k1, k2), as returned by rectification._rectify(..., return_params=True).
+    :param rect_to: (t1, t2, translation) of (k1, k3).
+    :return: H x W float32 disparities, nan where the source frame has no pixel.
+    """
+    t_from, _, translation_from = rect_from
+    t_to, _, translation_to = rect_to
+    center = coord_imcenter(disparity_map)
+    mat = affine_mat(t_from) @ np.linalg.inv(affine_mat(t_to))
+    offset = np.ravel(center + translation_from - (center + translation_to) @ mat.T)
+    M = np.concatenate([mat, offset[:, None]], axis=1)
+    return cv2.warpAffine(disparity_map.astype(np.float32), M, disparity_map.shape[::-1],
+                          flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP,
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=np.nan)
+
+def fit_prior(prior, q1, q2, iterations=3):
+    """
+    fits the disparities of the new pair as a * prior + b on its keypoints (the tilt ratio and the
+    difference of translation alignments), discarding outliers.
+    :param prior: H x W warped disparities of a neighbouring pair.
+    :param q1: N x 2 rectified keypoints of img1 of the new pair.
+    :param q2: N x 2 rectified keypoints of img2 of the new pair.
+    :return: a, b, or None if there are not enough keypoints on the prior.
+    """
+    height, width = prior.shape
+    x, y = np.rint(q1).astype(int).T
+    inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+    p = np.full(q1.shape[0], np.nan)
+    p[inside] = prior[y[inside], x[inside]]
+    d = (q2 - q1)[:, 0]
+    keep = np.isfinite(p)
+
+    for _ in range(iterations):
+        if keep.sum() < 3:
+            return None
+        A = np.stack([p[keep], np.ones(keep.sum())], axis=1)
+        (a, b), *_ = np.linalg.lstsq(A, d[keep], rcond=None)
+        residuals = np.abs(d - (a * np.nan_to_num(p) + b))
+        keep &= residuals <= max(3 * np.median(residuals[keep]), 1)
+    return a, b
+
+class SeriesSGM:
+    def __init__(self, parameters, radius=4, paths=None):
+        """
+        SGM driver for the pairs of an ordered tilt series.
+        the first pair of each reference image is matched over the full disparity range. The next ones
+        reuse the last disparity map of the same reference image, warped into their rectified frame and
+        rescaled, as the center of per-pixel search windows of 2 x radius + 1 disparities.
+        :param parameters: structure containing parameters of the algorithm.
+        :param radius: half size of the search windows.
+        :param paths: structure containing all directions in which to aggregate costs.
+        """
+        self.parameters = parameters
+        self.radius = radius
+        self.paths = paths
+        self.matcher = SGMMatcher(parameters, paths)
+        self.last = {}
+
+    def prior(self, k1, rect, q1, q2):
+        """
+        :return: H x W expected disparities of the pair (k1, .), or None without usable neighbouring pair.
+        """
+        if k1 not in self.last:
+            return None
+        disparity_map, rect_from = self.last[k1]
+        prior = warp_disparity(disparity_map, rect_from, rect)
+        fit = fit_prior(prior, q1, q2)
+        if fit is None:
+            return None
+
+        # pixels the neighbouring pair does not cover are interpolated along their scanline
+        prior[np.isnan(prior)] = -1
+        prior = fill_invalid(prior, invalid=-1)
+        prior[prior == -1] = np.median(prior[prior != -1])
+        a, b = fit
+        return a * prior + b
+
+    def compute(self, pair, img1, img2, q1, q2, rect):
+        """
+        :param pair: (k1, k2) keys of the pair.
+        :param img1: rectified (blurred) img1, disparities are in its frame.
+        :param img2: rectified (blurred) img2.
+        :param q1: N x 2 rectified keypoints of img1.
+        :param q2: N x 2 rectified keypoints of img2.
+        :param rect: (t1, t2, translation) of the pair, from rectification._rectify(..., return_params=True).
+        :return: H x W disparity map.
+        """
+        k1, _ = pair
+        prior = self.prior(k1, rect, q1, q2)
+        if prior is None:
+            disparity_map = self.matcher.compute(img2, img1).copy()
+        else:
+            disparity_map = sgm_window(img2, img1, prior, self.radius, self.parameters, self.paths)
+        self.last[k1] = (disparity_map, rect)
+        return disparity_map
@@ -1,8 +1,11 @@
 import sys
 import time as t
+from collections import deque, OrderedDict
 
 import cv2
 import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 
 class Direction:
     def __init__(self, direction=(0, 0), name='invalid'):
@@ -100,7 +103,7 @@ def get_indices(offset, dim, direction, height):
 def aggregate_costs(cost_volume, parameters, paths):
     """
     second step of the sgm algorithm, aggregates matching costs for N possible directions (8 in this case).
-    :param cost_volume: array containing the matching costs.
+    :param cost_volume: array containing the matching costs, only read (a cached read-only memory map works as is).
     :param parameters: structure containing parameters of the algorithm.
     :param paths: structure containing all directions in which to aggregate costs.
     :return: H x W x D x N array of matching cost for all defined directions.
@@ -323,9 +326,11 @@ def compute_costs(left, right, parameters, save_images):
 
     return cost_volume
 
-def sgm(left, right):
+def sgm(left, right, subpixel=False):
     """
     main function applying the semi-global matching algorithm.
+    :param subpixel: return fixed-point subpixel disparities cleaned by postprocess instead of
+                     the median filtered uint8 map.
     :return: void.
     """
     output_name = "./data/output"
@@ -348,6 +353,12 @@ def sgm(left, right):
     print('\nStarting aggregation computation...')
     aggregation_volume = aggregate_costs(cost_volume, parameters, paths)
 
+    if subpixel:
+        print('\nSelecting best subpixel disparities...')
+        disparity_map = subpixel_disparity(np.sum(aggregation_volume, axis=3))
+        print('\nPost-processing...')
+        return postprocess(disparity_map, parameters)
+
     print('\nSelecting best disparities...')
     disparity_map = np.uint8(normalize(select_disparity(aggregation_volume), parameters))
     
@@ -431,17 +442,24 @@ def compare_census(left_census_values, right_census_values, height, width, dispa
 
     return cost_volume
 
-def census_costs(left, right, parameters):
+def census_costs(left, right, parameters, cache=None):
     """
     first step of the sgm algorithm, matching cost based on census transform and hamming distance.
     :param left: left image.
     :param right: right image.
     :param parameters: structure containing parameters of the algorithm.
-    :return: H x W x D array with the matching costs.
+    :param cache: optional CostCache, the volume is then only computed once per images, csize and max_disparity.
+    :return: H x W x D array with the matching costs (read-only if cached).
     """
     assert left.shape[0] == right.shape[0] and left.shape[1] == right.shape[1], 'left & right must have the same shape.'
     assert parameters.max_disparity > 0, 'maximum disparity must be greater than 0.'
 
+    if cache is not None:
+        key = cache.key(left, right, parameters, "census")
+        cost_volume = cache.get(key)
+        if cost_volume is not None:
+            return cost_volume
+
     height = left.shape[0]
     width  = left.shape[1]
     cheight = parameters.csize[0]
@@ -464,6 +482,8 @@ def census_costs(left, right, parameters):
     dusk = t.time()
     print('\t(done in {:.2f} s)'.format(dusk - dawn))
 
+    if cache is not None:
+        cost_volume = cache.put(key, cost_volume)
     return cost_volume
 
 def _pixel_correl(image):
@@ -506,7 +526,13 @@ def compare_correl(left_census_values, right_census_values, height, width, dispa
 
     return cost_volume
 
-def correl_costs(left, right, parameters):
+def correl_costs(left, right, parameters, cache=None):
+    if cache is not None:
+        key = cache.key(left, right, parameters, "correl")
+        cost_volume = cache.get(key)
+        if cost_volume is not None:
+            return cost_volume
+
     height = left.shape[0]
     width  = left.shape[1]
     cheight = parameters.csize[0]
@@ -516,7 +542,740 @@ def correl_costs(left, right, parameters):
     disparity = parameters.max_disparity
 
     left_feat, right_feat =  images_correl(left, right, height, width, x_offset, y_offset)
-    return compare_correl(left_feat, right_feat, height, width, disparity, x_offset)
+    cost_volume = compare_correl(left_feat, right_feat, height, width, disparity, x_offset)
+    if cache is not None:
+        cost_volume = cache.put(key, cost_volume)
+    return cost_volume
+
+def _path_step(previous, current, P1, P2, out=None, buffers=None, minimum=None):
+    """
+    one step of the path recurrence for a batch of pixels, in O(D) instead of the D x D penalty table
+    of get_path_cost (both are equal as long as P1 <= P2).
+    :param previous: ... x D path costs of the previous pixels along the path.
+    :param current: ... x D matching costs of the current pixels.
+    :param P1: penalty for disparity difference = 1, broadcastable against previous[..., :1].
+    :param P2: penalty for disparity difference > 1, broadcastable against previous[..., :1].
+    :param out: optional ... x D output array.
+    :param buffers: optional (best, shifted, minimum) work arrays shaped like previous, previous and previous[..., :1].
+    :param minimum: minimum of the previous path costs, when previous has been realigned by _align.
+    :return: ... x D path costs of the current pixels.
+    """
+    if buffers is None:
+        buffers = (np.empty_like(previous), np.empty_like(previous), None)
+    best, shifted = buffers[:2]
+    if minimum is None:
+        minimum = np.min(previous, axis=-1, keepdims=True, out=buffers[2])
+    np.add(minimum, P2, out=best)
+    np.minimum(best, previous, out=best)
+    np.add(previous, P1, out=shifted)
+    np.minimum(best[..., 1:], shifted[..., :-1], out=best[..., 1:])
+    np.minimum(best[..., :-1], shifted[..., 1:], out=best[..., :-1])
+    np.subtract(best, minimum, out=best)
+    return np.add(current, best, out=out)
+
+def _align(previous, shift, P2):
+    """
+    realigns path costs on the disparity windows of the next pixels, for per-pixel disparity windows.
+    :param previous: L x K path costs, on windows starting at o.
+    :param shift: L differences between the window starts of the next pixels and o.
+    :param P2: penalty for disparity difference > 1.
+    :return: L x K realigned path costs (minimum + P2 outside the previous windows) and their L x 1 minimum.
+    """
+    window = previous.shape[-1]
+    minimum = previous.min(axis=-1, keepdims=True)
+    index = np.arange(window) + shift[:, None]
+    outside = np.logical_or(index < 0, index >= window)
+    aligned = np.take_along_axis(previous, np.clip(index, 0, window - 1), axis=-1)
+    np.copyto(aligned, np.broadcast_to(minimum + P2, aligned.shape), where=outside)
+    return aligned, minimum
+
+def _aggregate_path(cost_volume, direction, P1, P2, out, previous=None, buffers=None, offsets=None):
+    """
+    aggregates matching costs along one direction with a line sweep: each step of the recurrence
+    handles a whole row (or column) of pixels at once.
+    :param cost_volume: H x W x ... x D array containing the matching costs.
+    :param direction: (x, y) cardinal direction of the path.
+    :param P1: penalty for disparity difference = 1.
+    :param P2: penalty for disparity difference > 1.
+    :param out: H x W x ... x D array to which the path costs are added.
+    :param previous: path costs of the line preceding the volume, to continue a vertical path across blocks.
+    :param buffers: optional (lines, best, shifted, minimum) work arrays of max(H, W) x D (lines has a leading
+                    axis of 2), so that the sweep does not allocate.
+    :param offsets: optional H x W first disparity of each pixel, when the last axis is a per-pixel window.
+    :return: path costs of the last line swept (a view on lines when buffers are given).
+    """
+    dx, dy = direction
+    if dy == 0:
+        # horizontal paths sweep the columns
+        cost_volume = cost_volume.swapaxes(0, 1)
+        out = out.swapaxes(0, 1)
+        if offsets is not None:
+            offsets = offsets.swapaxes(0, 1)
+        dx, dy = dy, dx
+
+    # pixels of the line with a predecessor, and their predecessors in the previous line
+    if dx == 0:
+        current_pixels, previous_pixels, first = slice(None), slice(None), None
+    elif dx > 0:
+        current_pixels, previous_pixels, first = slice(1, None), slice(None, -1), 0
+    else:
+        current_pixels, previous_pixels, first = slice(None, -1), slice(1, None), -1
+
+    size, length = out.shape[:2]
+    lines = range(size) if dy > 0 else range(size - 1, -1, -1)
+    for i, y in enumerate(lines):
+        current = cost_volume[y]
+        if buffers is None:
+            path = np.empty(out.shape[1:], dtype=out.dtype)
+            step = None
+        else:
+            path = buffers[0][i % 2][:length]
+            step = [buffer[:length - abs(dx)] for buffer in buffers[1:]]
+        if previous is None:
+            path[...] = current
+        else:
+            if first is not None:
+                path[first] = current[first]
+            predecessors, minimum = previous[previous_pixels], None
+            if offsets is not None:
+                shift = offsets[y][current_pixels] - offsets[y - dy][previous_pixels]
+                if shift.any():
+                    predecessors, minimum = _align(predecessors, shift, P2)
+            _path_step(predecessors, current[current_pixels], P1, P2, path[current_pixels], step, minimum)
+        out[y] += path
+        previous = path
+    return previous
+
+def aggregate_costs_sweep(cost_volume, penalties, paths, q=None, disparities=None, chunk=4):
+    """
+    aggregates matching costs for several (P1, P2) settings in a single pass.
+    the path recurrence runs over a penalty axis, so each line of the cost volume is read once for all settings.
+    settings are swept chunk at a time and reduced to their disparity map, so memory stays at chunk
+    aggregation volumes.
+    :param cost_volume: H x W x D array containing the matching costs.
+    :param penalties: list of K (P1, P2) pairs.
+    :param paths: structure containing all directions in which to aggregate costs.
+    :param q: optional N x 2 keypoint coordinates (x, y) in the frame of the disparity maps.
+    :param disparities: N disparities of the keypoints, required with q.
+    :param chunk: number of settings aggregated together.
+    :return: K x H x W disparity maps, and the K scores of score_disparities if q is given.
+    """
+    penalties = np.asarray(penalties, dtype=cost_volume.dtype).reshape(-1, 2)
+    height, width, disparity = cost_volume.shape
+    chunk = max(min(chunk, len(penalties)), 1)
+
+    disparity_maps = np.empty(shape=(len(penalties), height, width), dtype=np.intp)
+    buffer = np.empty(shape=(height, width, chunk, disparity), dtype=np.uint32)
+    costs = cost_volume[:, :, None, :]
+    for start in range(0, len(penalties), chunk):
+        settings = penalties[start:start + chunk]
+        P1 = settings[:, 0, None]
+        P2 = settings[:, 1, None]
+        volume = buffer[:, :, :len(settings)]
+        volume.fill(0)
+        for path in paths.paths:
+            print('\tProcessing path {} for {} settings...'.format(path.name, len(settings)), end='')
+            sys.stdout.flush()
+            dawn = t.time()
+            _aggregate_path(costs, path.direction, P1, P2, volume)
+            dusk = t.time()
+            print('\t(done in {:.2f} s)'.format(dusk - dawn))
+        disparity_maps[start:start + len(settings)] = np.moveaxis(np.argmin(volume, axis=3), 2, 0)
+
+    if q is None:
+        return disparity_maps
+    return disparity_maps, score_disparities(disparity_maps, q, disparities)
+
+def score_disparities(disparity_maps, q, disparities):
+    """
+    scores disparity maps against sparse matches, e.g. the keypoints kept by the rectification.
+    :param disparity_maps: K x H x W (or H x W) disparity maps.
+    :param q: N x 2 keypoint coordinates (x, y) in the frame of the disparity maps.
+    :param disparities: N expected disparities of the keypoints.
+    :return: K mean absolute disparity errors (lower is better).
+    """
+    disparity_maps = np.asarray(disparity_maps)
+    disparities = np.asarray(disparities)
+    height, width = disparity_maps.shape[-2:]
+    x, y = np.round(q).astype(int).T
+    msk = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+    errors = np.abs(disparity_maps[..., y[msk], x[msk]] - disparities[msk])
+    return errors.mean(axis=-1)
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+_H01 = np.uint64(0x0101010101010101)
+
+def _popcount(values):
+    """
+    number of set bits of each element, through a byte lookup table.
+    :param values: n dimension array of unsigned integers.
+    :return: uint32 array of the same shape.
+    """
+    values = np.ascontiguousarray(values)
+    bits = _POPCOUNT[values.view(np.uint8)].reshape(values.shape + (values.itemsize,))
+    return bits.sum(axis=-1, dtype=np.uint32)
+
+def _census_transform(image, csize):
+    """
+    vectorized census transform, bit for bit the one of _pixel_census (pixels on the border are 0).
+    :param image: H x W image.
+    :param csize: size of the kernel for the census transform.
+    :return: H x W array of census values.
+    """
+    height, width = image.shape
+    y_offset = int(csize[0] / 2)
+    x_offset = int(csize[1] / 2)
+    image = image.astype(np.int64)
+
+    census = np.zeros(shape=(height, width), dtype=np.uint64)
+    inner = census[y_offset:height - y_offset, x_offset:width - x_offset]
+    center = image[y_offset:height - y_offset, x_offset:width - x_offset]
+    for j in range(2 * y_offset + 1):
+        for i in range(2 * x_offset + 1):
+            if (i, j) != (y_offset, x_offset):
+                inner <<= np.uint64(1)
+                inner |= image[j:j + inner.shape[0], i:i + inner.shape[1]] < center
+    return census
+
+def _census_columns(width, disparity, x_offset):
+    """
+    columns of the right census compared to each (column, disparity) of the left census by compare_census,
+    including its wrap around near the right border.
+    :param width: W of the images.
+    :param disparity: number of disparities.
+    :param x_offset: half width of the census kernel.
+    :return: W x D array of columns and W array of columns that have a census value.
+    """
+    x = np.arange(width)[:, None]
+    d = np.arange(disparity)[None, :]
+    columns = np.where(x < width - d - x_offset, x + d, x + d - disparity)
+    valid = np.logical_and(x[:, 0] >= x_offset, x[:, 0] < width - x_offset)
+    return np.clip(columns, 0, width - 1), valid
+
+def _census_cost_volume(left_census_values, right_census_values, disparity, x_offset):
+    """
+    vectorized hamming distances between census values, over the full width of the census.
+    follows the naming of compare_census: left_census_values is the census of the right image.
+    :param left_census_values: ... x W census values.
+    :param right_census_values: ... x W census values.
+    :param disparity: number of disparities.
+    :param x_offset: half width of the census kernel.
+    :return: ... x W x D array with the matching costs.
+    """
+    columns, valid = _census_columns(left_census_values.shape[-1], disparity, x_offset)
+    cost_volume = _popcount(left_census_values[..., None] ^ right_census_values[..., columns])
+    cost_volume[..., ~valid, :] = 0
+    return cost_volume
+
+def _stream_costs(rows, parameters, block):
+    """
+    computes matching costs on a rolling window of csize rows.
+    :param rows: iterable of (left_row, right_row) pairs.
+    :param parameters: structure containing parameters of the algorithm.
+    :param block: number of cost rows per yielded block.
+    :return: generator of block x W x D cost arrays, in row order.
+    """
+    y_offset = int(parameters.csize[0] / 2)
+    x_offset = int(parameters.csize[1] / 2)
+    disparity = parameters.max_disparity
+    left_window = deque(maxlen=2 * y_offset + 1)
+    right_window = deque(maxlen=2 * y_offset + 1)
+    costs = []
+    nrows = 0
+
+    for left_row, right_row in rows:
+        left_window.append(left_row)
+        right_window.append(right_row)
+        nrows += 1
+        if nrows <= y_offset:
+            # rows on the top border have no census values
+            costs.append(np.zeros(shape=(len(left_row), disparity), dtype=np.uint32))
+        elif len(left_window) == left_window.maxlen:
+            left_census = _census_transform(np.array(right_window), parameters.csize)[y_offset]
+            right_census = _census_transform(np.array(left_window), parameters.csize)[y_offset]
+            costs.append(_census_cost_volume(left_census, right_census, disparity, x_offset))
+        if len(costs) == block:
+            yield np.array(costs)
+            costs = []
+
+    # rows on the bottom border have no census values
+    for y in range(min(y_offset, nrows - y_offset)):
+        costs.append(np.zeros(shape=(len(left_window[-1]), disparity), dtype=np.uint32))
+        if len(costs) == block:
+            yield np.array(costs)
+            costs = []
+    if costs:
+        yield np.array(costs)
+
+def sgm_stream(rows, parameters, block=16):
+    """
+    semi-global matching on a stream of rows, with bounded memory.
+    costs are computed on the fly on a rolling window of csize rows, and aggregated only along the causal
+    directions (west-east, east-west, north-south, north-west-south-east, north-east-south-west).
+    the state is a few block x W x D arrays whatever the height of the images.
+    :param rows: iterable of (left_row, right_row) pairs of the blurred images, e.g. zip(left, right)
+                 on arrays or memory maps.
+    :param parameters: structure containing parameters of the algorithm.
+    :param block: rows aggregated together; the west-east paths are vectorized over them.
+    :return: generator of disparity rows, one per input row.
+    """
+    assert parameters.max_disparity > 0, 'maximum disparity must be greater than 0.'
+    P1, P2 = parameters.P1, parameters.P2
+    previous = {S.direction: None, SE.direction: None, SW.direction: None}
+
+    for cost_volume in _stream_costs(rows, parameters, block):
+        volume = np.zeros(shape=cost_volume.shape, dtype=np.uint32)
+        for direction in (E.direction, W.direction):
+            _aggregate_path(cost_volume, direction, P1, P2, volume)
+        for direction in previous:
+            previous[direction] = _aggregate_path(cost_volume, direction, P1, P2, volume, previous[direction])
+        for disparity_row in np.argmin(volume, axis=2):
+            yield disparity_row
+
+def sgm_window(left, right, centers, radius, parameters, paths=None):
+    """
+    semi-global matching restricted to a window of disparities around a per-pixel prior.
+    costs and aggregation are computed on the 2 x radius + 1 disparities of each window only;
+    the path recurrence realigns the windows of neighbouring pixels.
+    uses the conventions of census_costs (disparities are in the frame of right).
+    :param left: left image (blurred).
+    :param right: right image (blurred).
+    :param centers: H x W expected disparities.
+    :param radius: half size of the windows.
+    :param parameters: structure containing parameters of the algorithm.
+    :param paths: structure containing all directions in which to aggregate costs.
+    :return: H x W disparity map.
+    """
+    assert left.shape == right.shape == centers.shape, 'left, right & centers must have the same shape.'
+    paths = paths if paths is not None else Paths()
+    disparity = parameters.max_disparity
+    window = min(2 * radius + 1, disparity)
+    x_offset = int(parameters.csize[1] / 2)
+    height, width = left.shape
+    offsets = np.clip(np.rint(centers).astype(np.int64) - radius, 0, disparity - window)
+
+    left_census_values = _census_transform(right, parameters.csize)
+    right_census_values = _census_transform(left, parameters.csize)
+    columns, valid = _census_columns(width, disparity, x_offset)
+    columns = columns[np.arange(width)[None, :, None], offsets[:, :, None] + np.arange(window)]
+    cost_volume = _popcount(left_census_values[:, :, None] ^
+                            right_census_values[np.arange(height)[:, None, None], columns])
+    cost_volume[:, ~valid] = 0
+
+    volume = np.zeros(shape=cost_volume.shape, dtype=np.uint32)
+    for path in paths.paths:
+        _aggregate_path(cost_volume, path.direction, parameters.P1, parameters.P2, volume, offsets=offsets)
+    return offsets + np.argmin(volume, axis=2)
+
+class SGMMatcher:
+    def __init__(self, parameters, paths=None):
+        """
+        semi-global matcher that owns its work buffers, for batches of same sized rectified pairs.
+        buffers only grow when the image shape or the disparity range grows, so running it on a stream
+        of pairs does not allocate after the first one.
+        :param parameters: structure containing parameters of the algorithm.
+        :param paths: structure containing all directions in which to aggregate costs.
+        """
+        self.parameters = parameters
+        self.paths = paths if paths is not None else Paths()
+        self.capacity = (0, 0, 0)
+        self.columns = {}
+
+    def _reserve(self, height, width, disparity):
+        """
+        (re)allocates the work buffers if they are too small for an H x W x D problem.
+        """
+        if all(n <= c for n, c in zip((height, width, disparity), self.capacity)):
+            return
+        height, width, disparity = [max(n, c) for n, c in zip((height, width, disparity), self.capacity)]
+        length = max(height, width)
+        self.capacity = (height, width, disparity)
+        self.columns = {}
+
+        self._image = np.empty(height * width, dtype=np.int64)
+        self._compare = np.empty(height * width, dtype=bool)
+        self._census = np.empty((2, height * width), dtype=np.uint64)
+        self._xor = np.empty(height * width, dtype=np.uint64)
+        self._tmp = np.empty(height * width, dtype=np.uint64)
+        self._costs = np.empty(height * width * disparity, dtype=np.uint32)
+        self._volume = np.empty(height * width * disparity, dtype=np.uint32)
+        self._disparity = np.empty(height * width, dtype=np.intp)
+        self._lines = np.empty(2 * length * disparity, dtype=np.uint32)
+        self._step = np.empty((2, length * disparity), dtype=np.uint32)
+        self._minimum = np.empty(length, dtype=np.uint32)
+
+    @staticmethod
+    def _view(buffer, shape):
+        """
+        contiguous view on the beginning of a flat buffer.
+        """
+        return buffer[:int(np.prod(shape))].reshape(shape)
+
+    def _census_into(self, image, census):
+        """
+        census transform of image into census, same values as _census_transform.
+        """
+        height, width = image.shape
+        y_offset = int(self.parameters.csize[0] / 2)
+        x_offset = int(self.parameters.csize[1] / 2)
+        inner_shape = (height - 2 * y_offset, width - 2 * x_offset)
+
+        values = self._view(self._image, image.shape)
+        values[...] = image
+        compare = self._view(self._compare, inner_shape)
+        census.fill(0)
+        inner = census[y_offset:height - y_offset, x_offset:width - x_offset]
+        center = values[y_offset:height - y_offset, x_offset:width - x_offset]
+        for j in range(2 * y_offset + 1):
+            for i in range(2 * x_offset + 1):
+                if (i, j) != (y_offset, x_offset):
+                    np.left_shift(inner, 1, out=inner)
+                    np.less(values[j:j + inner_shape[0], i:i + inner_shape[1]], center, out=compare)
+                    np.bitwise_or(inner, compare, out=inner)
+
+    def _costs_into(self, left_census_values, right_census_values, cost_volume):
+        """
+        hamming distances of _census_cost_volume into cost_volume.
+        """
+        height, width, disparity = cost_volume.shape
+        x_offset = int(self.parameters.csize[1] / 2)
+        if (width, disparity) not in self.columns:
+            self.columns[(width, disparity)] = _census_columns(width, disparity, x_offset)[0]
+        columns = self.columns[(width, disparity)]
+
+        xor = self._view(self._xor, (height, width))
+        tmp = self._view(self._tmp, (height, width))
+        for d in range(disparity):
+            np.take(right_census_values, columns[:, d], axis=1, out=xor, mode='clip')
+            np.bitwise_xor(xor, left_census_values, out=xor)
+            # in place bit counting (SWAR popcount)
+            np.right_shift(xor, 1, out=tmp)
+            np.bitwise_and(tmp, _M1, out=tmp)
+            np.subtract(xor, tmp, out=xor)
+            np.right_shift(xor, 2, out=tmp)
+            np.bitwise_and(tmp, _M2, out=tmp)
+            np.bitwise_and(xor, _M2, out=xor)
+            np.add(xor, tmp, out=xor)
+            np.right_shift(xor, 4, out=tmp)
+            np.add(xor, tmp, out=xor)
+            np.bitwise_and(xor, _M4, out=xor)
+            np.multiply(xor, _H01, out=xor)
+            np.right_shift(xor, 56, out=xor)
+            np.copyto(cost_volume[:, :, d], xor, casting='unsafe')
+        cost_volume[:, :x_offset] = 0
+        cost_volume[:, width - x_offset:] = 0
+
+    def compute(self, left, right, out=None, subpixel=False):
+        """
+        runs census, cost computation, aggregation along all paths and disparity selection.
+        uses the conventions of census_costs (disparities are in the frame of right).
+        :param left: left image (blurred).
+        :param right: right image (blurred).
+        :param out: optional H x W intp array receiving the disparity map.
+        :param subpixel: also refine the disparities with subpixel_disparity (out is then an int16 array).
+        :return: H x W disparity map. Without out, it is a view on a buffer overwritten by the next call.
+        """
+        assert left.shape == right.shape, 'left & right must have the same shape.'
+        assert self.parameters.max_disparity > 0, 'maximum disparity must be greater than 0.'
+        height, width = left.shape
+        disparity = self.parameters.max_disparity
+        self._reserve(height, width, disparity)
+        length = max(height, width)
+
+        left_census_values = self._view(self._census[0], (height, width))
+        right_census_values = self._view(self._census[1], (height, width))
+        self._census_into(right, left_census_values)
+        self._census_into(left, right_census_values)
+
+        cost_volume = self._view(self._costs, (height, width, disparity))
+        self._costs_into(left_census_values, right_census_values, cost_volume)
+
+        volume = self._view(self._volume, (height, width, disparity))
+        volume.fill(0)
+        buffers = (self._view(self._lines, (2, length, disparity)),
+                   self._view(self._step[0], (length, disparity)),
+                   self._view(self._step[1], (length, disparity)),
+                   self._view(self._minimum, (length, 1)))
+        for path in self.paths.paths:
+            _aggregate_path(cost_volume, path.direction, self.parameters.P1, self.parameters.P2, volume,
+                            buffers=buffers)
+
+        disparity_map = self._view(self._disparity, (height, width))
+        if not subpixel:
+            if out is None:
+                out = disparity_map
+            return np.argmin(volume, axis=2, out=out)
+        np.argmin(volume, axis=2, out=disparity_map)
+        return subpixel_disparity(volume, disparity_map, out=out)
+
+DISP_SCALE = 16
+
+def subpixel_disparity(volume, disparity_map=None, out=None):
+    """
+    winner-takes-all disparities refined by fitting a parabola on the costs around the minimum.
+    :param volume: H x W x D array of aggregated costs (summed over the paths).
+    :param disparity_map: optional argmin of volume over the disparities, if already computed.
+    :param out: optional H x W int16 array.
+    :return: H x W int16 fixed-point disparities (disparity * DISP_SCALE).
+    """
+    if disparity_map is None:
+        disparity_map = np.argmin(volume, axis=2)
+    disparities = volume.shape[2]
+    d = np.clip(disparity_map, 1, disparities - 2)[..., None]
+    c0, c1, c2 = [np.take_along_axis(volume, d + i, axis=2)[..., 0].astype(np.float32) for i in (-1, 0, 1)]
+
+    denominator = c0 - 2 * c1 + c2
+    refine = np.logical_and(denominator > 0, (d[..., 0] == disparity_map))
+    offset = np.zeros(shape=disparity_map.shape, dtype=np.float32)
+    np.divide(c0 - c2, 2 * denominator, out=offset, where=refine)
+    np.clip(offset, -.5, .5, out=offset)
+
+    if out is None:
+        out = np.empty(shape=disparity_map.shape, dtype=np.int16)
+    np.rint((disparity_map + offset) * DISP_SCALE, out=offset)
+    out[...] = offset
+    return out
+
+def filter_speckles(disparity_map, max_size, max_diff=DISP_SCALE, invalid=-1):
+    """
+    invalidates small regions of disparities inconsistent with their surroundings.
+    4-connected pixels are in the same region if their disparities differ by at most max_diff.
+    regions are built from horizontal runs of each scanline, joined by the vertical links between rows,
+    so the cost is linear in the number of pixels.
+    :param disparity_map: H x W disparities (e.g. fixed-point from subpixel_disparity).
+    :param max_size: regions with less pixels are invalidated.
+    :param max_diff: maximum disparity difference between neighbours of a region.
+    :param invalid: value of invalid pixels, ignored and used to mark the speckles.
+    :return: filtered copy of disparity_map.
+    """
+    height, width = disparity_map.shape
+    disp = disparity_map.astype(np.int32)
+    valid = disparity_map != invalid
+
+    # a run starts wherever a pixel is not linked to its left neighbour
+    linked = np.logical_and(np.logical_and(valid[:, 1:], valid[:, :-1]),
+                            np.abs(disp[:, 1:] - disp[:, :-1]) <= max_diff)
+    starts = np.ones(shape=(height, width), dtype=bool)
+    starts[:, 1:] = ~linked
+    runs = np.cumsum(starts).reshape(height, width) - 1
+    nruns = runs[-1, -1] + 1
+
+    # union of the runs linked vertically
+    vertical = np.logical_and(np.logical_and(valid[1:], valid[:-1]),
+                              np.abs(disp[1:] - disp[:-1]) <= max_diff)
+    edges = csr_matrix((np.ones(vertical.sum(), dtype=np.int8), (runs[:-1][vertical], runs[1:][vertical])),
+                       shape=(nruns, nruns))
+    _, components = connected_components(edges, directed=False)
+
+    labels = components[runs]
+    sizes = np.bincount(labels[valid], minlength=components.max() + 1)
+    speckles = np.logical_and(valid, sizes[labels] < max_size)
+
+    filtered = disparity_map.copy()
+    filtered[speckles] = invalid
+    return filtered
+
+def fill_invalid(disparity_map, invalid=-1):
+    """
+    fills invalid pixels by linear interpolation between the closest valid pixels of their scanline
+    (or copies the only one found at the ends of the line).
+    :param disparity_map: H x W disparities.
+    :param invalid: value of invalid pixels.
+    :return: filled copy of disparity_map, rows without valid pixel stay invalid.
+    """
+    height, width = disparity_map.shape
+    valid = disparity_map != invalid
+    columns = np.broadcast_to(np.arange(width), (height, width))
+
+    left = np.maximum.accumulate(np.where(valid, columns, -1), axis=1)
+    right = np.minimum.accumulate(np.where(valid, columns, width)[:, ::-1], axis=1)[:, ::-1]
+    has_left, has_right = left >= 0, right < width
+    rows = np.arange(height)[:, None]
+    left_value = disparity_map[rows, np.clip(left, 0, width - 1)].astype(np.float32)
+    right_value = disparity_map[rows, np.clip(right, 0, width - 1)].astype(np.float32)
+
+    span = np.maximum(right - left, 1)
+    weight = (columns - left) / span
+    values = np.where(has_left, left_value, right_value)
+    both = np.logical_and(has_left, has_right)
+    values[both] = (1 - weight[both]) * left_value[both] + weight[both] * right_value[both]
+
+    filled = disparity_map.copy()
+    fill = np.logical_and(~valid, np.logical_or(has_left, has_right))
+    filled[fill] = np.rint(values[fill])
+    return filled
+
+def postprocess(disparity_map, parameters, max_speckle=100, max_diff=DISP_SCALE, invalid=-1):
+    """
+    speckle filtering followed by the scanline filling of the invalid pixels.
+    pixels on the border of the census, that have no matching cost, are considered invalid.
+    :param disparity_map: H x W fixed-point disparities from subpixel_disparity.
+    :param parameters: structure containing parameters of the algorithm.
+    :param max_speckle: regions with less pixels are removed.
+    :param max_diff: maximum disparity difference (in fixed-point) inside a region.
+    :return: H x W int16 fixed-point disparities.
+    """
+    y_offset = int(parameters.csize[0] / 2)
+    x_offset = int(parameters.csize[1] / 2)
+    disparity_map = disparity_map.copy()
+    disparity_map[:y_offset] = invalid
+    disparity_map[disparity_map.shape[0] - y_offset:] = invalid
+    disparity_map[:, :x_offset] = invalid
+    disparity_map[:, disparity_map.shape[1] - x_offset:] = invalid
+
+    disparity_map = filter_speckles(disparity_map, max_speckle, max_diff, invalid)
+    disparity_map = fill_invalid(disparity_map, invalid)
+    # the border rows have no valid pixel to interpolate from
+    valid_rows = np.flatnonzero((disparity_map != invalid).any(axis=1))
+    if valid_rows.size:
+        disparity_map[:valid_rows[0]] = disparity_map[valid_rows[0]]
+        disparity_map[valid_rows[-1] + 1:] = disparity_map[valid_rows[-1]]
+    return disparity_map
+
+class DisparityQuery:
+    def __init__(self, left, right, parameters, paths=None, margin=64, tile=64, max_bytes=2**28):
+        """
+        on-demand disparities for regions or points of a rectified pair.
+        a query only computes the costs of the region plus a context margin on each side, in which the
+        aggregation paths can settle, so that results match the full-image run. census and cost tiles
+        are cached (least recently used first out), so repeated nearby queries reuse them.
+        uses the conventions of census_costs (disparities are in the frame of right).
+        :param left: left image (blurred).
+        :param right: right image (blurred).
+        :param parameters: structure containing parameters of the algorithm.
+        :param paths: structure containing all directions in which to aggregate costs.
+        :param margin: context added around the queried region, in pixels.
+        :param tile: size of the cached tiles.
+        :param max_bytes: memory budget of the tile cache.
+        """
+        assert left.shape == right.shape, 'left & right must have the same shape.'
+        self.images = (right, left)
+        self.parameters = parameters
+        self.paths = paths if paths is not None else Paths()
+        self.margin = margin
+        self.tile = tile
+        self.max_bytes = max_bytes
+        self.tiles = OrderedDict()
+        self.nbytes = 0
+        self.shape = left.shape
+        x_offset = int(parameters.csize[1] / 2)
+        self.columns, self.valid = _census_columns(left.shape[1], parameters.max_disparity, x_offset)
+
+    def _cached(self, key, fn, *args):
+        if key in self.tiles:
+            self.tiles.move_to_end(key)
+            return self.tiles[key]
+        value = fn(*args)
+        self.tiles[key] = value
+        self.nbytes += value.nbytes
+        while self.nbytes > self.max_bytes and len(self.tiles) > 1:
+            self.nbytes -= self.tiles.popitem(last=False)[1].nbytes
+        return value
+
+    def _tile_range(self, ty, tx):
+        height, width = self.shape
+        return (ty * self.tile, min((ty + 1) * self.tile, height),
+                tx * self.tile, min((tx + 1) * self.tile, width))
+
+    def _census_tile(self, which, ty, tx):
+        """
+        census of a tile, computed with the neighbouring pixels so that it equals the full-image census.
+        """
+        height, width = self.shape
+        y0, y1, x0, x1 = self._tile_range(ty, tx)
+        y_offset = int(self.parameters.csize[0] / 2)
+        x_offset = int(self.parameters.csize[1] / 2)
+        py0, py1 = max(y0 - y_offset, 0), min(y1 + y_offset, height)
+        px0, px1 = max(x0 - x_offset, 0), min(x1 + x_offset, width)
+        census = _census_transform(self.images[which][py0:py1, px0:px1], self.parameters.csize)
+        return census[y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+
+    def _region(self, fn, y0, y1, x0, x1):
+        """
+        assembles the cached tiles of fn covering a region.
+        """
+        ty0, ty1 = y0 // self.tile, (y1 - 1) // self.tile + 1
+        tx0, tx1 = x0 // self.tile, (x1 - 1) // self.tile + 1
+        rows = [np.concatenate([fn(ty, tx) for tx in range(tx0, tx1)], axis=1) for ty in range(ty0, ty1)]
+        region = np.concatenate(rows, axis=0)
+        return region[y0 - ty0 * self.tile:y1 - ty0 * self.tile, x0 - tx0 * self.tile:x1 - tx0 * self.tile]
+
+    def _census(self, which, y0, y1, x0, x1):
+        return self._region(lambda ty, tx: self._cached(('census', which, ty, tx), self._census_tile, which, ty, tx),
+                            y0, y1, x0, x1)
+
+    def _cost_tile(self, ty, tx):
+        """
+        matching costs of a tile, equal to the ones of _census_cost_volume on the full images.
+        """
+        y0, y1, x0, x1 = self._tile_range(ty, tx)
+        columns = self.columns[x0:x1]
+        c0, c1 = columns.min(), columns.max() + 1
+        left_census_values = self._census(0, y0, y1, x0, x1)
+        right_census_values = self._census(1, y0, y1, c0, c1)
+        cost_volume = _popcount(left_census_values[:, :, None] ^ right_census_values[:, columns - c0])
+        cost_volume[:, ~self.valid[x0:x1]] = 0
+        return cost_volume
+
+    def costs(self, y0, y1, x0, x1):
+        """
+        :return: (y1 - y0) x (x1 - x0) x D matching costs, from the tile cache.
+        """
+        return self._region(lambda ty, tx: self._cached(('cost', ty, tx), self._cost_tile, ty, tx),
+                            y0, y1, x0, x1)
+
+    def query(self, corner=(200, 400), size=(400, 50)):
+        """
+        disparities of a region, same corner/size convention as geometry.crop_patch.
+        :return: h x w disparity map.
+        """
+        height, width = self.shape
+        x, y = corner
+        w, h = size
+        y0, y1 = max(y - self.margin, 0), min(y + h + self.margin, height)
+        x0, x1 = max(x - self.margin, 0), min(x + w + self.margin, width)
+
+        cost_volume = self.costs(y0, y1, x0, x1)
+        volume = np.zeros(shape=cost_volume.shape, dtype=np.uint32)
+        for path in self.paths.paths:
+            _aggregate_path(cost_volume, path.direction, self.parameters.P1, self.parameters.P2, volume)
+        return np.argmin(volume, axis=2)[y - y0:y - y0 + h, x - x0:x - x0 + w]
+
+    def query_points(self, q):
+        """
+        disparities at a list of points. points are grouped by the cached tiles they fall in: each group
+        of neighbouring tiles gets one query on the bounding box of its points, unless the box is mostly
+        empty (e.g. a diagonal), then each of its tiles gets its own query.
+        :param q: N x 2 (x, y) coordinates.
+        :return: N disparities.
+        """
+        disparities = np.empty(len(q), dtype=np.intp)
+        if len(q) == 0:
+            return disparities
+        x, y = np.rint(q).astype(int).T
+        tx, ty = x // self.tile, y // self.tile
+        occupied = np.zeros((ty.max() + 1, tx.max() + 1), dtype=np.uint8)
+        occupied[ty, tx] = 1
+        _, labels = cv2.connectedComponents(occupied, connectivity=8)
+
+        groups = []
+        for label in range(1, labels.max() + 1):
+            rows, cols = np.nonzero(labels == label)
+            box = (rows.max() - rows.min() + 1) * (cols.max() - cols.min() + 1)
+            if 2 * rows.size >= box:
+                groups.append(np.flatnonzero(labels[ty, tx] == label))
+            else:
+                groups.extend(np.flatnonzero((ty == r) & (tx == c)) for r, c in zip(rows, cols))
+
+        for group in groups:
+            x0, y0 = x[group].min(), y[group].min()
+            disparity_map = self.query((x0, y0), (x[group].max() - x0 + 1, y[group].max() - y0 + 1))
+            disparities[group] = disparity_map[y[group] - y0, x[group] - x0]
+        return disparities
 
 def test_legacy():
     cost_volume = census_costs(patch_left, patch_right, parameters)
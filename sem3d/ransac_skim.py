@@ -104,8 +104,10 @@ class FundamentalMatrix():
         e = (q*self.cd[None,:]).sum(1) + self.e
         return a, b, e
     
-def filter_outliers(q1, q2, min_samples=5, residual_threshold=1.):
+def filter_outliers(q1, q2, min_samples=5, residual_threshold=1., return_model=False):
     """
+        With return_model, also returns the fitted FundamentalMatrix,
+        so that plots can reuse it instead of fitting their own.
     """
     nkp = q1.shape[0]
     print(f"{nkp} keypoints matched")
@@ -115,4 +117,6 @@ def filter_outliers(q1, q2, min_samples=5, residual_threshold=1.):
     q1, q2 = q1[inliers], q2[inliers]
     nkp2 = q1.shape[0]
     print(f"{nkp-nkp2} keypoints filtered by ransac ({residual_threshold}). {nkp2} remaings")
+    if return_model:
+        return q1, q2, fund
     return q1, q2
\ No newline at end of file
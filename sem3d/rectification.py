@@ -10,40 +10,60 @@ def get_filtered_kp(img1, img2, feat="sift",
                  residual_threshold=.5,
                  coef_threshold=.7,
                  dist_threshold=100,
-                 min_samples=5):
+                 min_samples=5,
+                 roi=None,
+                 levels=0,
+                 max_per_cell=None):
     """
     """
-    q1, q2 = match_keypoints(img1, img2, 
+    q1, q2 = match_keypoints(img1, img2, feat=feat,
                      filter_coef=coef_threshold, 
                      filter_dist=dist_threshold, 
-                     filter_intesity=intensity_threshold)
+                     filter_intesity=intensity_threshold,
+                     roi=roi,
+                     levels=levels,
+                     max_per_cell=max_per_cell)
     
     q1, q2 = filter_outliers(q1, q2, 
                              min_samples=min_samples, 
                              residual_threshold=residual_threshold)
     return q1, q2
 
-def translation_alignment(img1, img2, q1, q2, x_margin=2):
+def translation_alignment(img1, img2, q1, q2, x_margin=2, return_params=False):
+    """
+        With return_params, also returns the translation applied to img1 and q1
+    """
     x_shift = (q1 - q2).max(0)[0] + x_margin
     y_shift = (q1 - q2).mean(0)[1]
     img1 = shift(img1, (-y_shift, -x_shift))
-    q1 -= np.array([[x_shift, y_shift]])
+    translation = -np.array([[x_shift, y_shift]])
+    q1 = q1 + translation
+    if return_params:
+        return img1, img2, q1, q2, translation
     return img1, img2, q1, q2
 
-def rotation_alignment(img1, img2, q1, q2):
+def rotation_alignment(img1, img2, q1, q2, return_params=False):
     """
+        With return_params, also returns the rotation angles t1, t2 applied to img1 and img2
     """
     t1, t2 = get_rotation_angles(q1, q2)
     img1, q1 = rotate_point_img(img1, q1, t1)
     img2, q2 = rotate_point_img(img2, q2, t2)
+    if return_params:
+        return img1, img2, q1, q2, (t1, t2)
     return img1, img2, q1, q2
 
-def _rectify(img1, img2, q1, q2, x_margin=5):
+def _rectify(img1, img2, q1, q2, x_margin=5, return_params=False):
     """
+        With return_params, also returns (t1, t2, translation), so that points of the original images
+        can be mapped to the rectified frames with geometry.affine_point
     """
-    img1, img2, q1, q2 = rotation_alignment(img1, img2, q1, q2)
-    img1, img2, q1, q2 = translation_alignment(img1, img2, q1, q2, 
-                                               x_margin=x_margin)
+    img1, img2, q1, q2, (t1, t2) = rotation_alignment(img1, img2, q1, q2, return_params=True)
+    img1, img2, q1, q2, translation = translation_alignment(img1, img2, q1, q2,
+                                                            x_margin=x_margin,
+                                                            return_params=True)
+    if return_params:
+        return img1, img2, q1, q2, (t1, t2, translation)
     return img1, img2, q1, q2
 
 def rectify(img1, img2, feat="sift", 
@@ -52,7 +72,10 @@ def rectify(img1, img2, feat="sift",
             coef_threshold=.7,
             dist_threshold=100,
             min_samples=5,
-            x_margin=2):
+            x_margin=2,
+            roi=None,
+            levels=0,
+            max_per_cell=None):
     """
     """
     q1, q2 = get_filtered_kp(img1, img2, feat=feat, 
@@ -60,6 +83,9 @@ def rectify(img1, img2, feat="sift",
                  residual_threshold = residual_threshold,
                  coef_threshold = coef_threshold,
                  dist_threshold = dist_threshold,
-                 min_samples = min_samples)
+                 min_samples = min_samples,
+                 roi = roi,
+                 levels = levels,
+                 max_per_cell = max_per_cell)
         
     return _rectify(img1, img2, q1, q2, x_margin=x_margin)
\ No newline at end of file
@@ -0,0 +1,107 @@
+import time as t
+
+import cv2
+import numpy as np
+from scipy.fft import dctn, idctn
+
+from .geometry import deg_to_rad
+from .pysgm import fill_invalid
+
+def disparity_to_height(disparity_map, tilt, scale=1, invalid=-1):
+    """
+    heights of a rectified pair with a eucentric tilt: z = d / (2 sin(tilt / 2)), up to a constant.
+    :param disparity_map: H x W disparities, in the frame of img1.
+    :param tilt: tilt difference of the pair, in degrees.
+    :param scale: size of a disparity unit in pixels (1 / DISP_SCALE for the fixed-point maps of pysgm).
+    :param invalid: value of invalid pixels, they are filled along their scanline.
+    :return: H x W float32 heights, in pixels.
+    """
+    if (disparity_map == invalid).any():
+        disparity_map = fill_invalid(disparity_map, invalid)
+    return (disparity_map * scale / (2 * np.sin(deg_to_rad(tilt) / 2))).astype(np.float32)
+
+def gradient(z):
+    """
+    forward differences, zero across the last row / column (Neumann boundary).
+    :return: gx, gy.
+    """
+    gx = np.zeros_like(z)
+    gy = np.zeros_like(z)
+    gx[:, :-1] = z[:, 1:] - z[:, :-1]
+    gy[:-1] = z[1:] - z[:-1]
+    return gx, gy
+
+def divergence(gx, gy):
+    """
+    backward differences, the negative adjoint of gradient.
+    """
+    div = np.zeros_like(gx)
+    div[:, 0] = gx[:, 0]
+    div[:, 1:-1] = gx[:, 1:-1] - gx[:, :-2]
+    div[:, -1] = -gx[:, -2]
+    div[0] += gy[0]
+    div[1:-1] += gy[1:-1] - gy[:-2]
+    div[-1] -= gy[-2]
+    return div
+
+def shading_gradient(img, height, sigma=4, max_slope=3, eps=1e-3):
+    """
+    surface gradient from the intensity of a secondary electron image.
+    the yield of a facet grows as 1 / cos(theta), theta being the angle between its normal and the beam,
+    so |grad z| = tan(theta) = sqrt((I / I0)^2 - 1). shading gives no direction: it is taken from the
+    smoothed stereo gradient. I0, the intensity of a flat facet, is fitted on the stereo slopes.
+    :param img: H x W rectified intensity image, in the frame of height.
+    :param height: H x W heights from the disparities.
+    :param sigma: standard deviation of the smoothing of the stereo heights.
+    :param max_slope: slopes are clipped, to bound the edge effect.
+    :return: gx, gy, I0.
+    """
+    intensity = cv2.GaussianBlur(img.astype(np.float32), (0, 0), 1)
+    hx, hy = gradient(cv2.GaussianBlur(height, (0, 0), sigma))
+    norm = np.sqrt(hx**2 + hy**2)
+
+    secant = np.sqrt(1 + norm**2)
+    I0 = (intensity * secant).sum() / (secant**2).sum()
+    slope = np.sqrt(np.clip((intensity / I0)**2 - 1, 0, max_slope**2))
+    # where the stereo surface is flat the direction is unknown, fall back to the stereo gradient
+    gx = np.where(norm > eps, slope * hx / np.maximum(norm, eps), hx)
+    gy = np.where(norm > eps, slope * hy / np.maximum(norm, eps), hy)
+    return gx, gy, I0
+
+def poisson_solve(height, gx, gy, mu=.01):
+    """
+    minimizes mu ||z - height||^2 + ||grad z - g||^2, i.e. solves (mu - laplacian) z = mu height - div g.
+    with Neumann boundaries the operator is diagonal in the DCT-II basis, hence an O(N log N) direct solve.
+    :param height: H x W stereo heights (data term).
+    :param gx: H x W target x gradient.
+    :param gy: H x W target y gradient.
+    :param mu: weight of the stereo heights, small values trust the gradients on larger scales.
+    :return: H x W float32 heights.
+    """
+    height_, width = height.shape
+    rhs = dctn(mu * height - divergence(gx, gy), type=2, norm="ortho", workers=-1)
+    ly = 2 - 2 * np.cos(np.pi * np.arange(height_) / height_)
+    lx = 2 - 2 * np.cos(np.pi * np.arange(width) / width)
+    rhs /= mu + ly[:, None] + lx[None, :]
+    return idctn(rhs, type=2, norm="ortho", workers=-1).astype(np.float32)
+
+def fuse(disparity_map, img, tilt, scale=1, mu=.01, sigma=4, max_slope=3, invalid=-1):
+    """
+    refines the stereo heights of a rectified pair with the shading of img1.
+    stereo fixes the low frequencies and the slope directions, shading the fine details.
+    :param disparity_map: H x W disparities from pysgm, in the frame of img.
+    :param img: H x W rectified img1.
+    :param tilt: tilt difference of the pair, in degrees.
+    :param scale: size of a disparity unit in pixels.
+    :param mu: weight of the stereo heights.
+    :param sigma: smoothing of the stereo heights for the slope directions.
+    :param max_slope: clipping of the shading slopes.
+    :return: H x W float32 heights, in pixels.
+    """
+    dawn = t.time()
+    print("\tFusing shading and stereo...", end='')
+    height = disparity_to_height(disparity_map, tilt, scale, invalid)
+    gx, gy, _ = shading_gradient(img, height, sigma, max_slope)
+    z = poisson_solve(height, gx, gy, mu)
+    print('\t(done in {:.2f} s)'.format(t.time() - dawn))
+    return z